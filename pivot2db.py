@@ -1,10 +1,70 @@
 #!/usr/bin/python3
 # pivot2db.py
 
+import os
+import sys
 import csv
+import json
+import math
+import time
 import pymysql
+from functools import lru_cache
 from db_config import get_db_connection
-from datetime import datetime
+from datetime import date, datetime
+
+BATCH_SIZE = 500  # Rows per executemany round trip
+SCHEMA_CACHE = os.path.expanduser('~/.cache/pivot2db_schema.json')
+
+PARTITIONS_AHEAD = 3     # Monthly partitions kept ready beyond the current month
+RETENTION_MONTHS = 24    # Older monthly partitions are dropped by --maintain
+MIGRATE_CHUNK = 5000     # Rows per transaction while copying into the partitioned table
+MIGRATE_ID_GAP = 1000000 # Ids kept free for rows the pollers write into the old table until the RENAME
+SCHEMA_ERRORS = (1054, 1146)  # Unknown column, table doesn't exist: the schema cache is stale
+
+# Columns that are not register values
+TEXT_COLUMNS = {'section', 'port'}
+INT_COLUMNS = {'unit_id'}
+KEY_COLUMN = 'sample_key'  # Idempotency key of buffered samples (sofar_buffer)
+
+def register_sql_type(register):
+    # Smallest exact type for the raw value range and the CSV accuracy
+    if register.type == 'ASCII':
+        return f"VARCHAR({register.width * 2})"
+    unsigned = "" if register.type.startswith('I') else " UNSIGNED"
+    integer_type = {1: "SMALLINT", 2: "INT", 4: "BIGINT"}.get(register.width, "BIGINT")
+    if register.scale == 1 or register.type == 'BCD16':
+        return integer_type + unsigned
+    if register.scale > 1:
+        return "BIGINT" + unsigned
+    decimals = round(-math.log10(register.scale))
+    if not math.isclose(10 ** -decimals, register.scale):
+        return "FLOAT"
+    digits = len(str(2 ** (16 * register.width) - 1))
+    return f"DECIMAL({max(digits, decimals + 1)},{decimals})"
+
+@lru_cache(maxsize=1)
+def register_column_types():
+    # Column name (as truncated for the table) -> SQL type, FLOAT for anything unknown
+    try:
+        from read import CSV_FILE, read_register_map_from_csv
+        register_map = read_register_map_from_csv(CSV_FILE)
+    except OSError as e:
+        print(f"Register map not available, using FLOAT columns: {e}")
+        return {}
+    types = {}
+    for register in register_map:
+        if register.name:
+            types.setdefault(truncate_column_name(register.name), register_sql_type(register))
+    return types
+
+def column_type(column):
+    if column == KEY_COLUMN:
+        return "CHAR(40)"
+    if column in TEXT_COLUMNS:
+        return "VARCHAR(255)"
+    if column in INT_COLUMNS:
+        return "INT"
+    return register_column_types().get(column, "FLOAT")
 
 def truncate_column_name(column_name):
     return column_name.split()[0]
@@ -15,6 +75,51 @@ def get_csv_columns(csv_file_path):
         columns = next(csv_reader)
     return [truncate_column_name(col) for col in columns]
 
+def load_schema_cache():
+    try:
+        with open(SCHEMA_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_schema_cache(schema_cache):
+    try:
+        os.makedirs(os.path.dirname(SCHEMA_CACHE), exist_ok=True)
+        with open(SCHEMA_CACHE, 'w') as f:
+            json.dump(schema_cache, f)
+    except OSError as e:
+        print(f"Could not write schema cache {SCHEMA_CACHE}: {e}")
+
+def schema_key(cursor, table_name):
+    # Per server and database: db_config may point somewhere else than when the entry was cached
+    connection = cursor.connection
+    database = connection.db.decode() if isinstance(connection.db, bytes) else connection.db
+    return f"{connection.host}/{database}/{table_name}"
+
+def ensure_table(cursor, table_name, columns, schema_cache):
+    # Skip SHOW TABLES / DESCRIBE when a previous run already verified these columns
+    key = schema_key(cursor, table_name)
+    known_columns = set(schema_cache.get(key, []))
+    if set(columns) <= known_columns:
+        return
+    check_and_update_table(cursor, table_name, columns)
+    cursor.execute(f"DESCRIBE `{table_name}`")
+    schema_cache[key] = [row[0] for row in cursor.fetchall()]
+    save_schema_cache(schema_cache)
+
+def insert_checked(cursor, table_name, columns, schema_cache, insert):
+    """ensure_table, then insert(); a table dropped or changed behind the cache is checked again once."""
+    ensure_table(cursor, table_name, columns, schema_cache)
+    try:
+        return insert()
+    except pymysql.err.MySQLError as e:
+        if not e.args or e.args[0] not in SCHEMA_ERRORS:
+            raise
+        print(f"Cached schema of {table_name} is stale ({e.args[1] if len(e.args) > 1 else e}), checking again")
+        schema_cache.pop(schema_key(cursor, table_name), None)
+        ensure_table(cursor, table_name, columns, schema_cache)
+        return insert()
+
 def check_and_update_table(cursor, table_name, columns):
     cursor.execute(f"SHOW TABLES LIKE '{table_name}'")
     table_exists = cursor.fetchone()
@@ -35,7 +140,10 @@ def check_and_update_table(cursor, table_name, columns):
                 print(f"Missing columns: {', '.join(missing_columns)}")
                 for col in missing_columns:
                     if col not in ['id', 'timestamp']:
-                        add_column_sql = f"ALTER TABLE `{table_name}` ADD COLUMN `{col}` FLOAT"
+                        add_column_sql = f"ALTER TABLE `{table_name}` ADD COLUMN `{col}` {column_type(col)}"
+                        if col == KEY_COLUMN:
+                            # Unique keys of a partitioned table must contain the partitioning column
+                            add_column_sql += f", ADD UNIQUE KEY `uniq_{col}` (`{col}`, `timestamp`)"
                         cursor.execute(add_column_sql)
                         print(f"Added new column: {col}")
             
@@ -50,50 +158,232 @@ def check_and_update_table(cursor, table_name, columns):
         print(f"Table {table_name} does not exist. Creating it.")
         create_table_if_not_exists(cursor, table_name, columns)
 
-def create_table_if_not_exists(cursor, table_name, columns):
-    column_definitions = [
-        f"`{col}` FLOAT" if col != "section" else f"`{col}` VARCHAR(255)"
-        for col in columns
-    ]
-    column_definitions = ["id INT AUTO_INCREMENT PRIMARY KEY", "timestamp DATETIME"] + column_definitions
-    
+def add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+def partition_definition(month):
+    return (f"PARTITION p{month:%Y%m} VALUES LESS THAN "
+            f"(TO_DAYS('{add_months(month, 1):%Y-%m-%d}'))")
+
+def create_table_if_not_exists(cursor, table_name, columns, first_month=None):
+    # Monthly RANGE partitions on timestamp: time-range queries only touch their months,
+    # and old months are dropped as a whole (see maintain_partitions)
+    column_definitions = [f"`{col}` {column_type(col)}" for col in columns if col not in ('id', 'timestamp')]
+    if KEY_COLUMN in columns:
+        column_definitions.append(f"UNIQUE KEY `uniq_{KEY_COLUMN}` (`{KEY_COLUMN}`, `timestamp`)")
+    column_definitions = ["id BIGINT NOT NULL AUTO_INCREMENT", "timestamp DATETIME NOT NULL"] + column_definitions
+    column_definitions += ["PRIMARY KEY (id, timestamp)", "KEY `idx_timestamp` (`timestamp`)"]
+
+    this_month = date.today().replace(day=1)
+    first_month = min(first_month or this_month, this_month)
+    months = []
+    month = first_month
+    while month <= add_months(this_month, PARTITIONS_AHEAD):
+        months.append(month)
+        month = add_months(month, 1)
+    partitions = [partition_definition(month) for month in months]
+    partitions.append("PARTITION pfuture VALUES LESS THAN MAXVALUE")
+
     create_table_sql = f"""
     CREATE TABLE IF NOT EXISTS `{table_name}` (
         {', '.join(column_definitions)}
     )
+    PARTITION BY RANGE (TO_DAYS(`timestamp`)) (
+        {', '.join(partitions)}
+    )
     """
     cursor.execute(create_table_sql)
 
+def table_partitions(cursor, table_name):
+    cursor.execute("""
+        SELECT PARTITION_NAME FROM INFORMATION_SCHEMA.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION""", (table_name,))
+    return [row[0] for row in cursor.fetchall()]
+
+def maintain_partitions(cursor, table_name, months_ahead=PARTITIONS_AHEAD, retention_months=RETENTION_MONTHS):
+    """Split the next months out of pfuture and drop months older than the retention."""
+    partitions = table_partitions(cursor, table_name)
+    if 'pfuture' not in partitions:
+        print(f"{table_name} is not partitioned, run pivot2db.py --migrate first")
+        return
+    existing = {name for name in partitions if name != 'pfuture'}
+
+    this_month = date.today().replace(day=1)
+    last_month = max((datetime.strptime(name[1:], '%Y%m').date() for name in existing), default=None)
+    month = add_months(last_month, 1) if last_month else this_month
+    new_months = []
+    while month <= add_months(this_month, months_ahead):
+        new_months.append(month)
+        month = add_months(month, 1)
+    if new_months:
+        definitions = [partition_definition(month) for month in new_months]
+        definitions.append("PARTITION pfuture VALUES LESS THAN MAXVALUE")
+        cursor.execute(f"ALTER TABLE `{table_name}` REORGANIZE PARTITION pfuture INTO ({', '.join(definitions)})")
+        print(f"Added partitions {', '.join(f'p{month:%Y%m}' for month in new_months)}")
+
+    cutoff = f"p{add_months(this_month, -retention_months):%Y%m}"
+    expired = sorted(name for name in existing if name < cutoff)
+    if expired:
+        # Dropping a partition is a metadata operation, no row-by-row DELETE
+        cursor.execute(f"ALTER TABLE `{table_name}` DROP PARTITION {', '.join(expired)}")
+        print(f"Dropped partitions {', '.join(expired)}")
+
+def copy_rows(cursor, source, target, columns, after_id):
+    """Copy the next chunk after after_id, returns (last id, rows copied, rows without a timestamp)."""
+    column_list = ', '.join(f"`{column}`" for column in columns)
+    cursor.execute(f"SELECT MAX(id) FROM (SELECT id FROM `{source}` WHERE id > %s ORDER BY id LIMIT %s) chunk",
+                   (after_id, MIGRATE_CHUNK))
+    last_id = cursor.fetchone()[0]
+    if last_id is None:
+        return after_id, 0, 0
+    # No IGNORE: a value the typed column cannot hold aborts the migration instead of being clamped
+    count = cursor.execute(f"INSERT INTO `{target}` ({column_list}) SELECT {column_list} FROM `{source}` "
+                           f"WHERE id > %s AND id <= %s AND `timestamp` IS NOT NULL", (after_id, last_id))
+    # The partitioning column cannot be NULL, these rows stay in the old table only
+    cursor.execute(f"SELECT COUNT(*) FROM `{source}` WHERE id > %s AND id <= %s AND `timestamp` IS NULL",
+                   (after_id, last_id))
+    return last_id, count, cursor.fetchone()[0]
+
+def migrate_table(connection, table_name):
+    """Move an unpartitioned table into the partitioned layout while the pollers keep writing.
+
+    Rows are copied in id-ordered chunks, then the tables are swapped with one RENAME and
+    rows that arrived in the old table meanwhile are copied over. Rows keep their ids;
+    an interrupted migration resumes after the highest id already copied.
+    """
+    new_table = f"{table_name}_partitioned"
+    old_table = f"{table_name}_unpartitioned"
+    with connection.cursor() as cursor:
+        if 'pfuture' in table_partitions(cursor, table_name):
+            print(f"{table_name} is already partitioned")
+            return
+        # Conversion errors into the DECIMAL/SMALLINT UNSIGNED columns must fail, not warn
+        cursor.execute("SET SESSION sql_mode = IF(@@SESSION.sql_mode = '', 'STRICT_ALL_TABLES', "
+                       "CONCAT(@@SESSION.sql_mode, ',STRICT_ALL_TABLES'))")
+        cursor.execute(f"DESCRIBE `{table_name}`")
+        columns = [row[0] for row in cursor.fetchall()]
+        cursor.execute(f"SELECT MIN(`timestamp`) FROM `{table_name}`")
+        oldest = cursor.fetchone()[0]
+        create_table_if_not_exists(cursor, new_table, columns, oldest.date().replace(day=1) if oldest else None)
+        connection.commit()
+
+        started = time.monotonic()
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM `{new_table}`")
+        last_id = cursor.fetchone()[0]
+        total = skipped = 0
+        while True:
+            chunk_end, count, without_timestamp = copy_rows(cursor, table_name, new_table, columns, last_id)
+            connection.commit()  # Short transactions, the pollers are never blocked for long
+            if chunk_end == last_id:
+                break
+            last_id = chunk_end
+            total += count
+            skipped += without_timestamp
+            print(f"Copied {total} rows (up to id {last_id}) in {time.monotonic() - started:.0f}s")
+
+        # After the RENAME the pollers take ids from the new table, while the catch-up below copies
+        # the old table's ids past last_id: start the new ids well above anything the old table hands out
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM `{table_name}`")
+        cursor.execute(f"ALTER TABLE `{new_table}` AUTO_INCREMENT = {cursor.fetchone()[0] + MIGRATE_ID_GAP}")
+        cursor.execute(f"RENAME TABLE `{table_name}` TO `{old_table}`, `{new_table}` TO `{table_name}`")
+        # Rows written between the last chunk and the RENAME
+        while True:
+            chunk_end, count, without_timestamp = copy_rows(cursor, old_table, table_name, columns, last_id)
+            connection.commit()
+            if chunk_end == last_id:
+                break
+            last_id = chunk_end
+            total += count
+            skipped += without_timestamp
+    print(f"Migrated {total} rows, the old table is kept as {old_table}")
+    if skipped:
+        print(f"Skipped {skipped} rows without a timestamp, they are only in {old_table}")
+
 def insert_data(cursor, table_name, data):
     columns = ', '.join([f"`{key}`" for key in data.keys()])
     placeholders = ', '.join(['%s'] * len(data))
     sql = f"INSERT INTO `{table_name}` ({columns}) VALUES ({placeholders})"
     cursor.execute(sql, list(data.values()))
 
+def insert_rows(cursor, table_name, columns, rows, batch_size=BATCH_SIZE, ignore_duplicates=False,
+                update_columns=None):
+    # pymysql rewrites executemany on INSERT ... VALUES into multi-row statements
+    column_list = ', '.join([f"`{column}`" for column in columns])
+    placeholders = ', '.join(['%s'] * len(columns))
+    ignore = "IGNORE " if ignore_duplicates else ""
+    sql = f"INSERT {ignore}INTO `{table_name}` ({column_list}) VALUES ({placeholders})"
+    if update_columns:
+        # Upsert: rows that hit an existing key replace these columns
+        sql += " ON DUPLICATE KEY UPDATE " + ', '.join(f"`{column}` = VALUES(`{column}`)" for column in update_columns)
+    batch = []
+    count = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            cursor.executemany(sql, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+def insert_columns(cursor, table_name, columns, timestamps=None):
+    # Column-oriented batch output (sofar_batch): one row per sample, NaN stored as NULL
+    names = [truncate_column_name(name) for name in columns]
+    values = [column.tolist() for column in columns.values()]
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = ([None if value != value else value for value in row] + [timestamps[index] if timestamps else now]
+            for index, row in enumerate(zip(*values)))
+    return insert_rows(cursor, table_name, names + ['timestamp'], rows)
+
+def load_csv(cursor, table_name, csv_file_path, schema_cache):
+    columns = get_csv_columns(csv_file_path)
+    # Truncation can map two CSV columns to one name, the last one wins
+    positions = list({column: index for index, column in enumerate(columns)}.items())
+    columns = [column for column, _ in positions]
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def insert():
+        with open(csv_file_path, 'r') as csv_file:
+            csv_reader = csv.reader(csv_file)
+            next(csv_reader)  # Header, already truncated in columns
+            # Short rows are padded with NULLs and blank lines skipped, as DictReader did
+            rows = ([row[index] if index < len(row) and row[index] != '' else None for _, index in positions]
+                    + [timestamp] for row in csv_reader if row)
+            return insert_rows(cursor, table_name, columns + ['timestamp'], rows)
+
+    return insert_checked(cursor, table_name, columns, schema_cache, insert)
+
 def main():
-    csv_file_path = '/tmp/pivoted_registers.csv'
+    # Several pivoted CSVs can be given to backfill them in one transaction.
+    # --migrate moves the table to the partitioned layout, --maintain (daily from cron)
+    # adds the coming monthly partitions and drops the expired ones.
+    csv_file_paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')] or ['/tmp/pivoted_registers.csv']
     table_name = 'inverter_data'
-    
+    schema_cache = load_schema_cache()
+
     try:
-        columns = get_csv_columns(csv_file_path)
-        print(f"CSV columns (truncated): {columns}")
-        
         connection = get_db_connection()
+        if '--migrate' in sys.argv or '--maintain' in sys.argv:
+            if '--migrate' in sys.argv:
+                migrate_table(connection, table_name)
+            with connection.cursor() as cursor:
+                maintain_partitions(cursor, table_name)
+            return
         with connection.cursor() as cursor:
-            check_and_update_table(cursor, table_name, columns)
-            
-            with open(csv_file_path, 'r') as csv_file:
-                csv_reader = csv.DictReader(csv_file)
-                for row in csv_reader:
-                    # Truncate column names in the row
-                    truncated_row = {truncate_column_name(k): v for k, v in row.items()}
-                    truncated_row['timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    insert_data(cursor, table_name, truncated_row)
-            
+            total = 0
+            for csv_file_path in csv_file_paths:
+                count = load_csv(cursor, table_name, csv_file_path, schema_cache)
+                print(f"{csv_file_path}: {count} rows")
+                total += count
+
             connection.commit()
-            print("Data inserted successfully")
-    except FileNotFoundError:
-        print(f"Error: CSV file not found at {csv_file_path}")
+            print(f"Data inserted successfully ({total} rows)")
+    except FileNotFoundError as e:
+        print(f"Error: CSV file not found: {e.filename}")
     except pymysql.err.OperationalError as e:
         print(f"Database connection error: {e}")
     except pymysql.err.ProgrammingError as e:
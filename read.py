@@ -1,13 +1,17 @@
 #!/usr/bin/python3
 
 import sys
-import csv
 import time
 from pymodbus.client.serial import ModbusSerialClient
 import logging
-from typing import Dict, List, Any, Optional
 import struct
 import pandas as pd
+from sofar_registers import RegisterMap, load_register_map
+from read_planner import read_planned
+from sofar_bus import BlockReader
+from sofar_profile import apply_profile, load_profile, profile_baudrate, profile_masks, profile_max_words
+from sofar_pipeline import make_sinks, write_samples
+from sofar_metrics import metrics, enable_from_argv
 
 TIMEOUT = 1
 
@@ -21,111 +25,14 @@ BAUD_RATE = 9600
 UNIT_ID = 3
 CSV_FILE = '/home/pi/python/sofarregister.csv'
 MAX_REGISTER = 0x1324
-BLOCK_SIZE = 32  # Read 32 registers at a time
+BLOCK_SIZE = 32  # Read 32 registers at a time, unless the device profile allows more
+GAP_TOLERANCE = 8  # Read across up to 8 unwanted registers to merge requests
 
-def read_register_info_from_csv(csv_file: str) -> Dict[int, Dict[str, Any]]:
-    register_info = {}
-    current_section = ""
-
-    with open(csv_file, mode='r', encoding='utf-8') as infile:
-        reader = csv.reader(infile, delimiter=';')
-        next(reader)  # Skip header
-
-        for row in reader:
-            if row and len(row) >= 2:
-                if not row[1] and row[0].strip():  # New section
-                    current_section = row[0].strip()
-                    print(f"New section detected: {current_section}")
-                elif row[1]:  # Register info
-                    address_range = row[1].replace(" ", "")
-                    try:
-                        if '____' in address_range:
-                            start, end = map(lambda x: int(x, 16), address_range.split('____'))
-                        elif '-' in address_range:
-                            parts = address_range.split('-')
-                            start = int(parts[0], 16)
-                            end = int(parts[1], 16) if parts[1] else start
-                        else:
-                            start = end = int(address_range, 16)
-
-                        for address in range(start, end + 1):
-                            if address <= MAX_REGISTER:
-                                accuracy_str = row[4].replace(',', '.')
-                                try:
-                                    accuracy = float(''.join(filter(lambda x: x.isdigit() or x == '.', accuracy_str)))
-                                except ValueError:
-                                    accuracy = 1  # Default to 1 if conversion fails
-
-                                register_info[address] = {
-                                    'section': current_section,
-                                    'name': row[2].strip(),
-                                    'type': row[3].strip().upper() if row[3].strip() else 'U16',
-                                    'accuracy': accuracy,
-                                    'unit': row[5].strip() if len(row) > 5 else ''
-                                }
-                    except ValueError as e:
-                        logging.warning(f"Invalid address range '{address_range}' for '{row[2]}': {e}")
-
-    return register_info
-
-def read_register_block(client: ModbusSerialClient, start_address: int, count: int) -> Optional[List[int]]:
-    try:
-        result = client.read_holding_registers(start_address, count, slave=UNIT_ID)
-        if not result.isError():
-            return result.registers
-        logging.error(f"Error reading registers at address 0x{start_address:04X}: {result}")
-        return None
-    except Exception as e:
-        logging.error(f"Exception reading registers at address 0x{start_address:04X}: {e}")
-        return None
-
-def decode_value(registers: List[int], reg_type: str, accuracy: float) -> Optional[Any]:
-    if not registers:
-        return None
+def read_register_map_from_csv(csv_file: str) -> RegisterMap:
+    return load_register_map(csv_file, MAX_REGISTER)
 
-    try:
-        if reg_type == 'U16':
-            value = registers[0]
-        elif reg_type == 'I16':
-            value = registers[0]
-            if value >= 32768:
-                value -= 65536
-        elif reg_type == 'U32':
-            value = (registers[0] << 16) | registers[1] if len(registers) >= 2 else registers[0]
-        elif reg_type == 'I32':
-            value = (registers[0] << 16) | registers[1] if len(registers) >= 2 else registers[0]
-            if value >= 2147483648:
-                value -= 4294967296
-        elif reg_type == 'U64':
-            if len(registers) >= 4:
-                value = (registers[0] << 48) | (registers[1] << 32) | (registers[2] << 16) | registers[3]
-            elif len(registers) >= 2:
-                value = (registers[0] << 16) | registers[1]
-            else:
-                value = registers[0]
-        elif reg_type == 'BCD16':
-            value = int(f"{registers[0]:04x}")
-        elif reg_type == 'ASCII':
-            ascii_chars = []
-            for reg in registers:
-                high_byte = reg >> 8
-                low_byte = reg & 0xFF
-                if high_byte:
-                    ascii_chars.append(chr(high_byte))
-                if low_byte:
-                    ascii_chars.append(chr(low_byte))
-            return ''.join(ascii_chars).strip('\x00')
-        else:
-            logging.warning(f"Unknown register type: {reg_type}")
-            return None
-
-        return value * accuracy if reg_type != 'ASCII' else value
-    except Exception as e:
-        logging.error(f"Error decoding value: {e}")
-        return None
-
-def read_address_mask(client, start_address):
-    mask_registers = read_register_block(client, start_address, 4)
+def read_address_mask(reader, start_address):
+    mask_registers = reader(start_address, 4)
     if mask_registers:
         return int.from_bytes(struct.pack('>HHHH', *mask_registers), byteorder='big')
     return 0
@@ -137,7 +44,16 @@ def get_valid_registers(mask, start_address, end_address):
             valid_registers.append(address)
     return valid_registers
 
+def read_planned_blocks(reader, spans, max_words=BLOCK_SIZE):
+    return read_planned(reader, spans, GAP_TOLERANCE, max_words, reader.failures)
+
 def pivot_registers(register_data):
+    if isinstance(register_data, dict):
+        # Batch-decoded columns (sofar_batch) are already one row per sample
+        pivoted = pd.DataFrame(register_data)
+        pivoted.insert(0, 'section', '')
+        return pivoted
+
     df = pd.DataFrame(register_data)
     
     # Remove the "I General" prefix from the section names
@@ -152,9 +68,67 @@ def pivot_registers(register_data):
     
     return pivoted
 
+SECTIONS = [
+    (0x0480, 0x04BF, 0x0480),
+    (0x0500, 0x053F, 0x0500),
+    (0x0580, 0x05BF, 0x0580),
+    (0x0600, 0x063F, 0x0600),
+    (0x0680, 0x06BF, 0x0680),
+]
+
+def poll_sections(reader, register_map, sections=SECTIONS, profile=None):
+    # Yields one sample dict per decoded register, so they can be streamed to a sink
+    current_section = ""
+    # A probed device profile saves the mask reads and allows larger requests
+    masks = profile_masks(profile)
+    max_words = profile_max_words(profile, BLOCK_SIZE)
+    decode_seconds = 0.0  # Summed over the poll, sofar_decode_seconds is per poll as in sofar_daemon
+
+    for start, end, mask_address in sections:
+        mask = masks.get(mask_address, 0) if masks is not None else read_address_mask(reader, mask_address)
+        valid_registers = get_valid_registers(mask, start, end)
+
+        wanted = [address for address in valid_registers
+                  if address in register_map and register_map[address].name]
+        spans = apply_profile([(address, register_map[address].width) for address in wanted], profile)
+        words = read_planned_blocks(reader, spans, max_words)
+
+        for address in wanted:
+            info = register_map[address]
+            if info.section != current_section:
+                current_section = info.section
+                print(f"\n--- {current_section} ---")
+
+            registers = words.get(address)
+            if registers:
+                decode_started = time.monotonic() if metrics.enabled else 0
+                value = info.decode(registers)
+                if metrics.enabled:
+                    decode_seconds += time.monotonic() - decode_started
+                if value is not None:
+                    formatted_value = f'"{value}"' if info.type == 'ASCII' else f"{value:.4f}" if isinstance(value, (int, float)) else str(value)
+                    print(f"0x{address:04X}: {info.name} ({info.type}) - {info.unit} : {formatted_value}")
+                    yield {
+                        'section': info.section,
+                        'name': info.name,
+                        'value': value,
+                        'unit': info.unit
+                    }
+                else:
+                    print(f"0x{address:04X}: {info.name} ({info.type}) - {info.unit} : Unable to decode value")
+            else:
+                print(f"0x{address:04X}: {info.name} ({info.type}) - {info.unit} : Unable to read register")
+    if metrics.enabled:
+        metrics.observe('sofar_decode_seconds', decode_seconds)
+
 def main():
     global TIMEOUT
-    client = ModbusSerialClient(method='rtu', port=SERIAL_PORT, baudrate=BAUD_RATE,
+    metrics_file = enable_from_argv(sys.argv)
+    profile = load_profile(SERIAL_PORT, UNIT_ID)
+    if profile is None:
+        logging.info("No device profile, run sofar_profile.py to probe the inverter")
+
+    client = ModbusSerialClient(method='rtu', port=SERIAL_PORT, baudrate=profile_baudrate(profile, BAUD_RATE),
                                 parity='N', stopbits=1, bytesize=8, timeout=TIMEOUT)
 
     if not client.connect():
@@ -163,57 +137,25 @@ def main():
         return
 
     logging.info("Connected to the inverter")
-    register_info = read_register_info_from_csv(CSV_FILE)
-    logging.info(f"Read {len(register_info)} register definitions from CSV")
+    register_map = read_register_map_from_csv(CSV_FILE)
+    logging.info(f"Read {len(register_map)} register definitions from CSV")
 
     print("Registers with specified names:")
-    current_section = ""
-    register_data = []
-
-    sections = [
-        (0x0480, 0x04BF, 0x0480),
-        (0x0500, 0x053F, 0x0500),
-        (0x0580, 0x05BF, 0x0580),
-        (0x0600, 0x063F, 0x0600),
-        (0x0680, 0x06BF, 0x0680),
-    ]
-
-    for start, end, mask_address in sections:
-        mask = read_address_mask(client, mask_address)
-        valid_registers = get_valid_registers(mask, start, end)
-
-        for address in valid_registers:
-            if address in register_info and register_info[address]['name']:
-                info = register_info[address]
-                if info['section'] != current_section:
-                    current_section = info['section']
-                    print(f"\n--- {current_section} ---")
-
-                reg_count = 4 if info['type'] == 'U64' else (2 if info['type'] in ['U32', 'I32'] else 1)
-                registers = read_register_block(client, address, reg_count)
-
-                if registers:
-                    value = decode_value(registers, info['type'], info['accuracy'])
-                    if value is not None:
-                        formatted_value = f'"{value}"' if info['type'] == 'ASCII' else f"{value:.4f}" if isinstance(value, (int, float)) else str(value)
-                        print(f"0x{address:04X}: {info['name']} ({info['type']}) - {info['unit']} : {formatted_value}")
-                        register_data.append({
-                            'section': info['section'],
-                            'name': info['name'],
-                            'value': value,
-                            'unit': info['unit']
-                        })
-                    else:
-                        print(f"0x{address:04X}: {info['name']} ({info['type']}) - {info['unit']} : Unable to decode value")
-                else:
-                    print(f"0x{address:04X}: {info['name']} ({info['type']}) - {info['unit']} : Unable to read register")
-
-    client.close()
+    started = time.monotonic()
+    sinks = []
+    try:
+        # Samples go straight to the database; --debug-csv also writes /tmp/pivoted_registers.csv
+        sinks = make_sinks(sys.argv)
+        write_samples(poll_sections(BlockReader(client, UNIT_ID, TIMEOUT), register_map, profile=profile), sinks)
+    finally:
+        client.close()
+        for sink in sinks:
+            sink.close()
+        if metrics.enabled:
+            metrics.observe('sofar_cycle_seconds', time.monotonic() - started, group='read')
+        if metrics_file:
+            metrics.write_file(metrics_file)  # One run is shorter than the periodic interval
     logging.info("Finished reading inverter data")
 
-    pivoted_data = pivot_registers(register_data)
-    pivoted_data.to_csv('/tmp/pivoted_registers.csv', index=False, quoting=csv.QUOTE_NONNUMERIC)
-    print("Pivoted register data saved to '/tmp/pivoted_registers.csv'")
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# read_planner.py
+#
+# Merges the registers we want into as few read_holding_registers requests
+# as the device allows and slices the returned words back per address.
+
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+GAP_TOLERANCE = 8   # Unwanted words we accept reading to save a round-trip
+MAX_WORDS = 32      # Largest request the inverter accepts
+
+# Number of 16-bit words per register type, everything else is one word
+REGISTER_WIDTHS = {'U64': 4, 'U32': 2, 'I32': 2}
+
+def register_width(reg_type: str) -> int:
+    return REGISTER_WIDTHS.get(reg_type, 1)
+
+def plan_reads(spans: Iterable[Tuple[int, int]], gap_tolerance: int = GAP_TOLERANCE,
+               max_words: int = MAX_WORDS) -> List[Tuple[int, int]]:
+    """Turn (address, width) spans into a list of (start, count) requests."""
+    blocks = []
+    block_start = block_end = None  # block_end is exclusive
+
+    for address, width in sorted(spans):
+        end = address + width
+        if block_start is not None:
+            if address <= block_end + gap_tolerance and max(end, block_end) - block_start <= max_words:
+                block_end = max(end, block_end)
+                continue
+            blocks.append((block_start, block_end - block_start))
+        block_start, block_end = address, end
+
+    if block_start is not None:
+        blocks.append((block_start, block_end - block_start))
+    return blocks
+
+def slice_block(block_start: int, registers: List[int],
+                spans: Iterable[Tuple[int, int]]) -> Dict[int, List[int]]:
+    """Pick the words of every span that lies inside a block read at block_start."""
+    words = {}
+    block_end = block_start + len(registers)
+    for address, width in spans:
+        if block_start <= address and address + width <= block_end:
+            offset = address - block_start
+            words[address] = registers[offset:offset + width]
+    return words
+
+def mapped_spans(register_map, max_register: int) -> List[Tuple[int, int]]:
+    """Spans for every register the CSV map defines, so unmapped holes are never requested."""
+    return [(register.start, register.width) for register in register_map.between(0, max_register)]
+
+def mask_addresses(register_map) -> List[int]:
+    return [register.start for register in register_map
+            if register.name.lower().startswith('addressmask')]
+
+def read_address_masks(read_block: Callable[[int, int], Optional[List[int]]],
+                       addresses: Iterable[int]) -> Dict[int, int]:
+    """Read the 64-bit AddressMask registers, skipping the ones the device does not offer."""
+    masks = {}
+    for address in addresses:
+        registers = read_block(address, 4)
+        if registers and len(registers) == 4:
+            mask = (registers[0] << 48) | (registers[1] << 32) | (registers[2] << 16) | registers[3]
+            if mask:
+                masks[address] = mask
+    return masks
+
+def apply_address_masks(spans: Iterable[Tuple[int, int]], masks: Dict[int, int]) -> List[Tuple[int, int]]:
+    """Drop spans whose address is flagged invalid by the mask covering its 64-address section."""
+    kept = []
+    for address, width in spans:
+        mask_address = next((m for m in masks if m <= address < m + 64), None)
+        if mask_address is None or masks[mask_address] & (1 << (address - mask_address)):
+            kept.append((address, width))
+    return kept
+
+def read_planned(read_block: Callable[[int, int], Optional[List[int]]], spans: List[Tuple[int, int]],
+                 gap_tolerance: int = GAP_TOLERANCE, max_words: int = MAX_WORDS,
+                 failures=None) -> Dict[int, List[int]]:
+    """Read all spans with planned requests, returning the words per address.
+
+    With failures (sofar_bus.BlockFailures) registers that fail on their own are
+    skipped, and merged blocks known to fail go straight to per-register reads.
+    """
+    if failures is not None:
+        spans = [(address, width) for address, width in spans if not failures.is_dead(address)]
+
+    words = {}
+    for block_start, count in plan_reads(spans, gap_tolerance, max_words):
+        registers = None
+        if failures is None or not failures.block_failed(block_start, count):
+            registers = read_block(block_start, count)
+        if registers:
+            words.update(slice_block(block_start, registers, spans))
+        else:
+            # The merged block was refused, fall back to one request per register
+            for address, width in spans:
+                if block_start <= address < block_start + count:
+                    registers = read_block(address, width)
+                    if registers:
+                        words[address] = registers
+                    elif failures is not None and failures.block_failed(address, width):
+                        failures.mark_dead(address)
+    return words
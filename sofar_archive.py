@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# sofar_archive.py
+#
+# Columnar history archive: one directory per day, one flat binary file per
+# register (float64 of the scaled value, NaN when a value is missing)
+# plus a timestamp column. The schema comes from the register map, so every
+# row has every column, and reading a month of one register only touches
+# that register's files.
+#
+# Usage: sofar_archive.py [--from YYYY-mm-dd] [--to YYYY-mm-dd] [--columns NAME,NAME,...]
+
+import os
+import re
+import sys
+import json
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, Optional
+import numpy as np
+import pandas as pd
+
+ARCHIVE_DIR = 'sofar_archive'
+SCHEMA_FILE = 'schema.json'
+TIMESTAMP_FILE = 'timestamp.f8'  # Seconds since the epoch
+FLUSH_ROWS = 60                  # Rows kept in memory before they are appended to the files
+
+def column_dtype(register) -> str:
+    # Values are stored scaled: 230.1 V in a float32 reads back as 230.10000610..., a float64
+    # returns the decoded value. Days written with 'f4' columns keep them in their schema.json.
+    return 'f8'
+
+def archive_schema(register_map) -> Dict[str, Dict[str, str]]:
+    """{register name: {'file': ..., 'dtype': ...}} for every numeric register in the map."""
+    schema = {}
+    for register in register_map:
+        if register.name and register.type != 'ASCII' and register.name not in schema:
+            safe_name = re.sub(r'[^\w.-]+', '_', register.name)
+            dtype = column_dtype(register)
+            schema[register.name] = {'file': f"{register.start:04X}_{safe_name}.{dtype}", 'dtype': dtype}
+    return schema
+
+def as_float(value) -> float:
+    return float(value) if isinstance(value, (int, float)) else np.nan
+
+def day_directory(archive_dir: str, day: date) -> str:
+    return os.path.join(archive_dir, day.strftime('%Y-%m-%d'))
+
+class ArchiveWriter:
+    def __init__(self, register_map, archive_dir: str = ARCHIVE_DIR, flush_rows: int = FLUSH_ROWS):
+        self.archive_dir = archive_dir
+        self.schema = archive_schema(register_map)
+        self.flush_rows = flush_rows
+        self.rows = []  # (timestamp, {name: value})
+
+    def append(self, values: Dict[str, Any], timestamp: float = None):
+        self.rows.append((timestamp or time.time(), values))
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def _open_day(self, directory: str) -> Dict[str, Dict[str, str]]:
+        # Keep the schema a day started with, add columns the map gained since
+        os.makedirs(directory, exist_ok=True)
+        schema_path = os.path.join(directory, SCHEMA_FILE)
+        schema = {}
+        if os.path.exists(schema_path):
+            with open(schema_path) as f:
+                schema = json.load(f)
+        added = {name: column for name, column in self.schema.items() if name not in schema}
+        timestamp_path = os.path.join(directory, TIMESTAMP_FILE)
+        row_count = os.path.getsize(timestamp_path) // 8 if os.path.exists(timestamp_path) else 0
+
+        for name, column in schema.items():
+            # An interrupted flush leaves some columns longer than the timestamps, cut them back
+            path = os.path.join(directory, column['file'])
+            size = row_count * np.dtype(column['dtype']).itemsize
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+        for name, column in added.items():
+            # Columns new to this day start with NaN for the rows written so far
+            np.full(row_count, np.nan, dtype=column['dtype']).tofile(os.path.join(directory, column['file']))
+
+        if added or not os.path.exists(schema_path):
+            schema.update(added)
+            with open(schema_path + '.tmp', 'w') as f:
+                json.dump(schema, f, ensure_ascii=False, indent=0)
+            os.replace(schema_path + '.tmp', schema_path)
+        return schema
+
+    def flush(self):
+        days = {}
+        for timestamp, values in self.rows:
+            days.setdefault(date.fromtimestamp(timestamp), []).append((timestamp, values))
+        self.rows = []
+
+        for day, rows in sorted(days.items()):
+            # Sorted within a flush, so read_archive usually takes the searchsorted path
+            rows.sort(key=lambda row: row[0])
+            directory = day_directory(self.archive_dir, day)
+            schema = self._open_day(directory)
+            for name, column in schema.items():
+                data = np.array([as_float(values.get(name)) for _, values in rows], dtype=float)
+                with open(os.path.join(directory, column['file']), 'ab') as f:
+                    data.astype(column['dtype']).tofile(f)
+            # Timestamps last: a row only exists once all of its columns are on disk
+            with open(os.path.join(directory, TIMESTAMP_FILE), 'ab') as f:
+                np.array([timestamp for timestamp, _ in rows], dtype='f8').tofile(f)
+
+    def close(self):
+        if self.rows:
+            self.flush()
+
+def read_archive(start: datetime, end: datetime, columns: Optional[Iterable[str]] = None,
+                 archive_dir: str = ARCHIVE_DIR) -> pd.DataFrame:
+    """Rows with start <= timestamp < end (local time), only the requested columns are read from disk.
+
+    The timestamp column comes back as UTC.
+    """
+    frames = []
+    day = start.date()
+    while day <= end.date():
+        directory = day_directory(archive_dir, day)
+        day += timedelta(days=1)
+        schema_path = os.path.join(directory, SCHEMA_FILE)
+        if not os.path.exists(schema_path):
+            continue
+        with open(schema_path) as f:
+            schema = json.load(f)
+
+        timestamps = np.fromfile(os.path.join(directory, TIMESTAMP_FILE), dtype='f8')
+        if (np.diff(timestamps) >= 0).all():
+            first, last = np.searchsorted(timestamps, [start.timestamp(), end.timestamp()])
+            rows = slice(first, last)
+        else:
+            # Appended out of order (clock step, back-dated deadband rows): select by mask, return sorted
+            rows = np.flatnonzero((timestamps >= start.timestamp()) & (timestamps < end.timestamp()))
+            rows = rows[np.argsort(timestamps[rows], kind='stable')]
+        selected = timestamps[rows]
+        if not len(selected):
+            continue
+
+        data = {'timestamp': pd.to_datetime(selected, unit='s', utc=True)}
+        for name in (columns if columns is not None else schema):
+            column = schema.get(name)
+            if column is None:
+                data[name] = np.full(len(selected), np.nan)
+                continue
+            values = np.memmap(os.path.join(directory, column['file']), dtype=column['dtype'], mode='r')
+            data[name] = np.array(values[rows], dtype=column['dtype'])
+        frames.append(pd.DataFrame(data))
+
+    if not frames:
+        return pd.DataFrame(columns=['timestamp'] + list(columns or []))
+    return pd.concat(frames, ignore_index=True)
+
+def main():
+    args = sys.argv[1:]
+    today = date.today()
+    start = datetime.strptime(args[args.index('--from') + 1], '%Y-%m-%d') if '--from' in args \
+        else datetime.combine(today, datetime.min.time())
+    end = datetime.strptime(args[args.index('--to') + 1], '%Y-%m-%d') + timedelta(days=1) if '--to' in args \
+        else start + timedelta(days=1)
+    columns = args[args.index('--columns') + 1].split(',') if '--columns' in args else None
+
+    read_archive(start, end, columns).to_csv(sys.stdout, index=False)
+
+if __name__ == "__main__":
+    main()
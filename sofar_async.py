@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# sofar_async.py
+#
+# Polls several inverters at once: every RS485 adapter gets its own asyncio
+# task, and the unit IDs daisy-chained on one adapter are polled back-to-back
+# over that port's single client. Samples are tagged with port and unit_id.
+# A port that fails is restarted on its own, the other ports keep polling.
+
+import sys
+import time
+import asyncio
+import logging
+from pymodbus.client import AsyncModbusSerialClient
+from read import CSV_FILE, BLOCK_SIZE, GAP_TOLERANCE, TIMEOUT, SECTIONS, read_register_map_from_csv
+from read_planner import apply_address_masks, mask_addresses, plan_reads, slice_block
+from sofar_pipeline import QueuedSink, make_sinks
+from sofar_profile import apply_profile, load_profile, profile_baudrate, profile_masks, profile_max_words
+
+POLL_INTERVAL = 5     # Seconds between cycles on each port
+RECONNECT_DELAY = 10  # Seconds to wait before reopening a port that failed or did not open
+
+# One entry per RS485 adapter, with the unit IDs on that bus
+INVERTERS = [
+    {'port': '/dev/ttyUSB32', 'baudrate': 9600, 'units': [3]},
+]
+
+async def connect(client, port):
+    while not await client.connect():
+        logging.error(f"Failed to open {port}, retrying in {RECONNECT_DELAY}s")
+        await asyncio.sleep(RECONNECT_DELAY)
+
+async def read_block(client, unit_id, start_address, count):
+    try:
+        result = await client.read_holding_registers(start_address, count, slave=unit_id)
+        if not result.isError():
+            return result.registers
+        logging.error(f"Error reading unit {unit_id} at 0x{start_address:04X}: {result}")
+    except Exception as e:
+        logging.error(f"Exception reading unit {unit_id} at 0x{start_address:04X}: {e}")
+    return None
+
+async def read_masks(client, unit_id, addresses):
+    masks = {}
+    for address in addresses:
+        registers = await read_block(client, unit_id, address, 4)
+        if registers and len(registers) == 4:
+            mask = (registers[0] << 48) | (registers[1] << 32) | (registers[2] << 16) | registers[3]
+            if mask:
+                masks[address] = mask
+    return masks
+
+async def poll_unit(client, port, unit_id, register_map, spans, max_words=BLOCK_SIZE):
+    samples = []
+    for block_start, count in plan_reads(spans, GAP_TOLERANCE, max_words):
+        registers = await read_block(client, unit_id, block_start, count)
+        if not registers:
+            continue
+        for address, words in slice_block(block_start, registers, spans).items():
+            info = register_map[address]
+            value = info.decode(words)
+            if value is not None:
+                samples.append({
+                    'port': port,
+                    'unit_id': unit_id,
+                    'section': info.section,
+                    'name': info.name,
+                    'value': value,
+                    'unit': info.unit
+                })
+    return samples
+
+async def poll_port(config, register_map, sinks):
+    port = config['port']
+    # All units on one bus share the rate, use the slowest one any of them stored
+    baudrate = min(profile_baudrate(load_profile(port, unit_id), config['baudrate']) for unit_id in config['units'])
+    client = AsyncModbusSerialClient(port=port, baudrate=baudrate, parity='N',
+                                     stopbits=1, bytesize=8, timeout=TIMEOUT)
+    try:
+        await connect(client, port)
+
+        # Masks are per unit: each inverter may offer a different register set
+        addresses = [register for start, end, _ in SECTIONS for register in register_map.between(start, end)
+                     if register.name]
+        unit_spans = {}
+        unit_words = {}
+        for unit_id in config['units']:
+            profile = load_profile(port, unit_id)
+            masks = profile_masks(profile)
+            if masks is None:
+                masks = await read_masks(client, unit_id, mask_addresses(register_map))
+            unit_spans[unit_id] = apply_profile(apply_address_masks([(r.start, r.width) for r in addresses], masks),
+                                                profile)
+            unit_words[unit_id] = profile_max_words(profile, BLOCK_SIZE)
+
+        while True:
+            started = time.monotonic()
+            if not client.connected:
+                await connect(client, port)
+
+            samples = []
+            for unit_id in config['units']:
+                samples.extend(await poll_unit(client, port, unit_id, register_map, unit_spans[unit_id],
+                                                   unit_words[unit_id]))
+            # The writer runs on its own thread, a slow database never stalls the event loop
+            sinks.put(samples)
+
+            await asyncio.sleep(max(0, POLL_INTERVAL - (time.monotonic() - started)))
+    finally:
+        client.close()
+
+async def supervise(config, register_map, sinks):
+    # Restarts one port's poller, an exception there must not cancel the other ports
+    while True:
+        try:
+            await poll_port(config, register_map, sinks)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Polling {config['port']} failed, restarting in {RECONNECT_DELAY}s: {e}")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+async def run(inverters):
+    register_map = read_register_map_from_csv(CSV_FILE)
+    sinks = QueuedSink(make_sinks(sys.argv))
+    try:
+        await asyncio.gather(*(supervise(config, register_map, sinks) for config in inverters))
+    finally:
+        sinks.close()
+
+def main():
+    try:
+        asyncio.run(run(INVERTERS))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+# sofar_batch.py
+#
+# Vectorized decoding of raw register images (one row of uint16 words per
+# sample) into columns keyed by register name. Used for full sweeps and for
+# re-decoding stored captures, where per-value Python decoding is too slow.
+# Registers sharing a name get ADDR_Name columns, so none overwrites another.
+
+from collections import Counter
+from typing import Dict, Optional
+import numpy as np
+from sofar_registers import RegisterMap
+
+# Big-endian view used to join consecutive words into 32/64-bit values
+WIDE_VIEWS = {'U32': '>u4', 'I32': '>i4', 'U64': '>u8'}
+
+def column_names(register_map: RegisterMap) -> Dict[int, str]:
+    """Column name per register start: the name, or ADDR_Name when several registers share it."""
+    counts = Counter(register.name for register in register_map if register.name)
+    return {register.start: register.name if counts[register.name] == 1 else f"{register.start:04X}_{register.name}"
+            for register in register_map if register.name}
+
+class BatchDecoder:
+    """Precomputed type groups for one register map and one image window."""
+
+    def __init__(self, register_map: RegisterMap, base_address: int, word_count: int):
+        self.base_address = base_address
+        self.word_count = word_count
+        self.groups = {}  # type -> (names, word offsets, scales)
+        self.ascii = []   # (name, register) decoded per row
+        names = column_names(register_map)  # Over the whole map, so a column is named the same in every window
+
+        for register in register_map.between(base_address, base_address + word_count - 1):
+            if not register.name or register.end > base_address + word_count:
+                continue
+            offset = register.start - base_address
+            if register.type == 'ASCII':
+                self.ascii.append((names[register.start], register, offset))
+                continue
+            group_names, offsets, scales = self.groups.setdefault(register.type, ([], [], []))
+            group_names.append(names[register.start])
+            offsets.append(range(offset, offset + register.width))
+            scales.append(register.scale)
+
+        self.groups = {reg_type: (group_names, np.array(offsets, dtype=np.intp), np.array(scales, dtype=np.float64))
+                       for reg_type, (group_names, offsets, scales) in self.groups.items()}
+
+    def decode(self, images: np.ndarray, valid: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """Decode a (samples, words) uint16 array; words flagged False in valid become NaN."""
+        images = np.atleast_2d(np.asarray(images, dtype=np.uint16))
+        if valid is not None:
+            valid = np.atleast_2d(valid)
+        columns = {}
+
+        for reg_type, (names, offsets, scales) in self.groups.items():
+            words = images[:, offsets]  # (samples, registers, width)
+            if reg_type in WIDE_VIEWS:
+                values = np.ascontiguousarray(words, dtype='>u2').view(WIDE_VIEWS[reg_type])[:, :, 0]
+            elif reg_type == 'I16':
+                values = words[:, :, 0].view(np.int16)
+            elif reg_type == 'BCD16':
+                raw = words[:, :, 0]
+                nibbles = np.stack([(raw >> shift) & 0x0F for shift in (12, 8, 4, 0)])
+                values = (nibbles * np.array([1000, 100, 10, 1])[:, None, None]).sum(axis=0).astype(np.float64)
+                values[(nibbles > 9).any(axis=0)] = np.nan
+            else:  # U16 and untyped words
+                values = words[:, :, 0]
+
+            if reg_type == 'U64' and valid is None and (scales == 1).all():
+                values = values.astype(np.uint64)  # Masks don't survive a float64 round trip
+            else:
+                values = values.astype(np.float64) * scales
+                if valid is not None:
+                    values[~valid[:, offsets].all(axis=2)] = np.nan
+
+            for index, name in enumerate(names):
+                columns[name] = values[:, index]
+
+        if self.ascii:
+            data = images.astype('>u2')
+            for name, register, offset in self.ascii:
+                columns[name] = np.array([register.decoder(row.tobytes(), offset * 2) for row in data], dtype=object)
+
+        return columns
+
+def decode_images(register_map: RegisterMap, base_address: int, images: np.ndarray,
+                  valid: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    images = np.atleast_2d(images)
+    return BatchDecoder(register_map, base_address, images.shape[1]).decode(images, valid)
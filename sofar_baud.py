@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# sofar_baud.py
+#
+# Moves the RS485 link to a faster baud rate through the RS485Config
+# registers (0x100B-0x100F). The new rate is only stored in the device profile
+# after test reads at that rate succeed; otherwise the old rate is written back.
+#
+# Usage: sofar_baud.py RATE --i-know [--port PORT] [--unit UNIT_ID]
+#
+# Every unit on the same bus must be switched, the pollers open one rate per port.
+#
+# The baud codes and the APPLY value are not from the protocol document: only
+# code 1 at 9600 baud has been seen on a device (result32.txt). A wrong code can
+# leave the inverter at a rate nobody expects, so --i-know is required. If the
+# inverter is lost, this script first searches every rate in BAUD_CODES; if that
+# fails, set the RS485 baud rate back to 9600 on the inverter's display (or in
+# the installer app) and delete "baudrate" from its sofar_profile.json entry.
+
+import sys
+import time
+import logging
+from pymodbus.client.serial import ModbusSerialClient
+from read import SERIAL_PORT, BAUD_RATE, UNIT_ID
+from sofar_profile import load_profile, profile_baudrate, save_profile
+
+RS485_CONFIG = 0x100B    # Address, Baud, StopBit, ParityBit, Control
+RS485_BAUD = 0x100C
+RS485_CONTROL = 0x100F
+APPLY = 1                # Control value that makes the inverter apply the new settings (unverified)
+
+# RS485Config_Baud codes, assumed in ascending order; only 9600 -> 1 is confirmed (result32.txt)
+BAUD_CODES = {4800: 0, 9600: 1, 19200: 2, 38400: 3, 57600: 4, 115200: 5}
+
+SETTLE_TIME = 1.0        # Seconds the inverter needs to reopen its UART
+TEST_ADDRESS = 0x0400    # Start of the realtime sections, always readable
+TEST_READS = 5           # All of them must succeed before the rate is kept
+
+def open_client(port, baudrate):
+    client = ModbusSerialClient(method='rtu', port=port, baudrate=baudrate,
+                                parity='N', stopbits=1, bytesize=8, timeout=1)
+    return client if client.connect() else None
+
+def test_reads(client, unit_id, count=TEST_READS):
+    for _ in range(count):
+        result = client.read_holding_registers(TEST_ADDRESS, 4, slave=unit_id)
+        if result.isError():
+            return False
+    return True
+
+def write_baud(client, unit_id, baudrate):
+    result = client.write_register(RS485_BAUD, BAUD_CODES[baudrate], slave=unit_id)
+    if result.isError():
+        return False
+    # The inverter switches after answering, the reply to this write may be lost
+    client.write_register(RS485_CONTROL, APPLY, slave=unit_id)
+    return True
+
+def link_works(port, unit_id, rate):
+    client = open_client(port, rate)
+    if client is None:
+        return False
+    try:
+        return test_reads(client, unit_id, 1)
+    finally:
+        client.close()
+
+def switch(port, unit_id, old_rate, new_rate):
+    """Switch old_rate -> new_rate, returns the rate the link ends up at (None if lost).
+
+    Raises ValueError when the inverter's baud code does not match old_rate,
+    before anything is written.
+    """
+    client = open_client(port, old_rate)
+    if client is None:
+        print(f"Cannot open {port}", file=sys.stderr)
+        return None
+    try:
+        config = client.read_holding_registers(RS485_CONFIG, 5, slave=unit_id)
+        if config.isError():
+            print(f"Unit {unit_id} does not answer at {old_rate} baud", file=sys.stderr)
+            return None
+        print(f"Current RS485 config: {config.registers}")
+        code = config.registers[RS485_BAUD - RS485_CONFIG]
+        if code != BAUD_CODES[old_rate]:
+            # Our table or the stored rate is wrong, writing codes now could lose the inverter
+            raise ValueError(f"Inverter reports baud code {code}, "
+                             f"expected {BAUD_CODES[old_rate]} for {old_rate} baud")
+        if not write_baud(client, unit_id, new_rate):
+            print("Inverter refused the new baud rate", file=sys.stderr)
+            return old_rate
+    finally:
+        client.close()
+
+    time.sleep(SETTLE_TIME)
+    client = open_client(port, new_rate)
+    if client is not None:
+        try:
+            if test_reads(client, unit_id):
+                return new_rate
+            # Answers, but not reliably enough at this rate: write the old rate back
+            logging.error(f"Test reads at {new_rate} baud failed, reverting to {old_rate}")
+            write_baud(client, unit_id, old_rate)
+        finally:
+            client.close()
+        time.sleep(SETTLE_TIME)
+
+    # Either the revert worked or the inverter never switched
+    if link_works(port, unit_id, old_rate):
+        return old_rate
+
+    # Lost: look for the inverter at every known rate and put it back on the old one
+    for rate in BAUD_CODES:
+        client = open_client(port, rate)
+        if client is None:
+            continue
+        try:
+            found = test_reads(client, unit_id, 1)
+            if found:
+                logging.error(f"Inverter found at {rate} baud, reverting to {old_rate}")
+                write_baud(client, unit_id, old_rate)
+        finally:
+            client.close()
+        if found:
+            time.sleep(SETTLE_TIME)
+            if link_works(port, unit_id, old_rate):
+                return old_rate
+            logging.error(f"Revert to {old_rate} baud did not take")
+            return rate if link_works(port, unit_id, rate) else None
+    return None
+
+def main():
+    args = sys.argv[1:]
+    if not args or not args[0].isdigit() or int(args[0]) not in BAUD_CODES:
+        print(f"Usage: sofar_baud.py RATE --i-know [--port PORT] [--unit UNIT_ID], RATE one of {sorted(BAUD_CODES)}",
+              file=sys.stderr)
+        sys.exit(2)
+    if '--i-know' not in args:
+        print("The baud codes are inferred from one device (9600 -> 1), not from the protocol table, and the\n"
+              "apply value is unverified. A wrong code can leave the inverter at a rate this script cannot find.\n"
+              "Recovery: set the RS485 baud rate back to 9600 on the inverter's display or in the installer app,\n"
+              "and remove \"baudrate\" from the unit's entry in sofar_profile.json.\n"
+              "Run again with --i-know to switch anyway.", file=sys.stderr)
+        sys.exit(2)
+    new_rate = int(args[0])
+    port = args[args.index('--port') + 1] if '--port' in args else SERIAL_PORT
+    unit_id = int(args[args.index('--unit') + 1]) if '--unit' in args else UNIT_ID
+
+    profile = load_profile(port, unit_id) or {}
+    old_rate = profile_baudrate(profile, BAUD_RATE)
+    if new_rate == old_rate:
+        print(f"Already at {old_rate} baud")
+        return
+
+    try:
+        rate = switch(port, unit_id, old_rate, new_rate)
+    except ValueError as e:
+        print(f"Not switching: {e}", file=sys.stderr)
+        sys.exit(1)
+    if rate is None:
+        logging.error(f"Lost unit {unit_id} on {port} while switching to {new_rate} baud")
+        print("Inverter not found at any baud rate, check the RS485 settings on its display", file=sys.stderr)
+        sys.exit(1)
+
+    profile['baudrate'] = rate
+    save_profile(port, unit_id, profile)
+    print(f"{port}:{unit_id} runs at {rate} baud" + ("" if rate == new_rate else f", {new_rate} did not work"))
+
+if __name__ == "__main__":
+    logging.basicConfig(filename='sofar_inverter.log', level=logging.ERROR,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
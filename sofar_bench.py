@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# sofar_bench.py
+#
+# End-to-end benchmark of the poll entry points against sofar_simulator.
+# Each entry point runs its normal main() with SERIAL_PORT pointed at the
+# simulator; the simulator counts requests and bytes on the wire.
+# Results are appended to sofar_bench.csv, and to the bench_results table with --db.
+# Exits 1 when an entry point fails, without writing anything when none ran.
+#
+# The pollers need the client API they are written for: pymodbus 3.0.x
+# (ModbusSerialClient(method='rtu'), slave=) plus pyserial for socket:// URLs.
+#
+# Usage: sofar_bench.py [--polls 5] [--latency 0.02] [--baud 9600] [--db] [ENTRY_POINT ...]
+
+import os
+import csv
+import sys
+import time
+import tempfile
+import importlib
+import statistics
+from contextlib import redirect_stdout
+from datetime import datetime
+from sofar_simulator import CSV_FILE, BAUD_RATE, LATENCY, make_simulator
+
+POLLS = 5
+BENCH_CSV = 'sofar_bench.csv'
+BENCH_TABLE = 'bench_results'
+PIVOT_CSV = os.path.join(tempfile.gettempdir(), 'sofar_bench_pivot.csv')
+
+# Entry point -> (module, command line flags for one poll)
+ENTRY_POINTS = {
+    'read.py': ('read', ['--no-db', '--debug-csv', PIVOT_CSV]),
+    'read_sofar2.py': ('read_sofar2', []),
+    'sofar_pivot.py': ('sofar_pivot', []),
+}
+
+FIELDS = ['timestamp', 'entry_point', 'polls', 'polls_per_sec', 'requests_per_poll', 'exceptions_per_poll',
+          'bytes_per_poll', 'latency_mean', 'latency_p95', 'baudrate', 'device_latency']
+
+def run_poll(module_name, args, url):
+    module = importlib.import_module(module_name)
+    module.SERIAL_PORT = url
+    module.CSV_FILE = CSV_FILE
+    sys.argv = [f"{module_name}.py"] + args
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        module.main()
+
+def run_pivot2db(polls):
+    # Times loading the CSV read.py wrote. CREATE/ALTER TABLE commit implicitly, so the table
+    # is created (and timed) before the loads and dropped afterwards; the rows are rolled back.
+    from db_config import get_db_connection
+    from pivot2db import ensure_table, get_csv_columns, load_csv
+
+    table_name = f"{BENCH_TABLE}_pivot2db"
+    connection = get_db_connection()
+    latencies = []
+    try:
+        with connection.cursor() as cursor:
+            schema_cache = {}
+            started = time.monotonic()
+            ensure_table(cursor, table_name, list(dict.fromkeys(get_csv_columns(PIVOT_CSV))), schema_cache)
+            print(f"pivot2db.py: schema setup {time.monotonic() - started:.4f}s, not part of the poll latency")
+            for _ in range(polls):
+                started = time.monotonic()
+                load_csv(cursor, table_name, PIVOT_CSV, schema_cache)
+                latencies.append(time.monotonic() - started)
+        connection.rollback()
+    finally:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS `{table_name}`")
+        finally:
+            connection.close()
+    return latencies
+
+def summarize(entry_point, latencies, counters, options):
+    polls = len(latencies)
+    ordered = sorted(latencies)
+    return {
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'entry_point': entry_point,
+        'polls': polls,
+        'polls_per_sec': round(polls / sum(latencies), 3) if sum(latencies) else 0,
+        'requests_per_poll': counters['requests'] / polls,
+        'exceptions_per_poll': counters['exceptions'] / polls,
+        'bytes_per_poll': (counters['bytes_in'] + counters['bytes_out']) / polls,
+        'latency_mean': round(statistics.mean(latencies), 4),
+        'latency_p95': round(ordered[min(polls - 1, int(polls * 0.95))], 4),
+        'baudrate': options['baudrate'],
+        'device_latency': options['latency'],
+    }
+
+def write_csv(results, path=BENCH_CSV):
+    new_file = not os.path.exists(path)
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(results)
+
+def write_db(results):
+    from db_config import get_db_connection
+    from pivot2db import insert_rows
+
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS `{BENCH_TABLE}` (
+                    id INT AUTO_INCREMENT PRIMARY KEY, timestamp DATETIME, entry_point VARCHAR(64),
+                    polls INT, polls_per_sec FLOAT, requests_per_poll FLOAT, exceptions_per_poll FLOAT,
+                    bytes_per_poll FLOAT, latency_mean FLOAT, latency_p95 FLOAT, baudrate INT, device_latency FLOAT
+                )""")
+            insert_rows(cursor, BENCH_TABLE, FIELDS, ([result[field] for field in FIELDS] for result in results))
+        connection.commit()
+    finally:
+        connection.close()
+
+def run_entry_point(entry_point, polls, server, options, args):
+    if entry_point == 'pivot2db.py':
+        if '--db' not in args:
+            print("pivot2db.py needs --db, skipped")
+            return None
+        counters = dict.fromkeys(('requests', 'exceptions', 'bytes_in', 'bytes_out'), 0)
+        return summarize(entry_point, run_pivot2db(polls), counters, options)
+
+    module_name, flags = ENTRY_POINTS[entry_point]
+    server.inverter.reset_counters()
+    latencies = []
+    for _ in range(polls):
+        started = time.monotonic()
+        run_poll(module_name, flags, server.url)
+        latencies.append(time.monotonic() - started)
+    return summarize(entry_point, latencies, server.inverter.counters(), options)
+
+def main():
+    args = sys.argv[1:]
+    polls = int(args[args.index('--polls') + 1]) if '--polls' in args else POLLS
+    options = {
+        'latency': float(args[args.index('--latency') + 1]) if '--latency' in args else LATENCY,
+        'baudrate': int(args[args.index('--baud') + 1]) if '--baud' in args else BAUD_RATE,
+    }
+    option_values = {args[i + 1] for i, arg in enumerate(args[:-1]) if arg in ('--polls', '--latency', '--baud')}
+    selected = [arg for arg in args if not arg.startswith('--') and arg not in option_values] or list(ENTRY_POINTS)
+    if '--db' in args and 'pivot2db.py' not in selected:
+        selected.append('pivot2db.py')
+
+    server = make_simulator(port=0, **options).start()
+    results = []
+    failed = []
+    workdir = tempfile.mkdtemp(prefix='sofar_bench_')
+    cwd = os.getcwd()
+    argv = sys.argv
+    try:
+        os.chdir(workdir)  # Archives, caches and CSVs the entry points write stay out of the tree
+        for entry_point in selected:
+            try:
+                result = run_entry_point(entry_point, polls, server, options, args)
+            except Exception as e:
+                print(f"{entry_point} failed: {type(e).__name__}: {e}", file=sys.stderr)
+                failed.append(entry_point)
+                continue
+            if result is None:
+                continue
+            results.append(result)
+            print(f"{entry_point}: {result['polls_per_sec']} polls/s, {result['requests_per_poll']:.0f} requests "
+                  f"and {result['bytes_per_poll']:.0f} bytes per poll, latency {result['latency_mean']}s "
+                  f"(p95 {result['latency_p95']}s)")
+    finally:
+        sys.argv = argv
+        os.chdir(cwd)
+        server.shutdown()
+        server.server_close()
+
+    if not results:
+        # Nothing measured, e.g. a pymodbus without method='rtu' or no pyserial for socket:// URLs
+        print("No entry point produced results, nothing written", file=sys.stderr)
+        sys.exit(1)
+    write_csv(results)
+    if '--db' in args:
+        write_db(results)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
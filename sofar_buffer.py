@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# sofar_buffer.py
+#
+# Store-and-forward: pivoted rows are committed to a local SQLite (WAL) file
+# first, and a forwarder thread drains them to MySQL in large batches once
+# the database is reachable. Every row carries a sample_key so a batch that
+# is re-sent after a lost commit is ignored by MySQL instead of duplicated.
+# Rows MySQL rejects for what they contain are moved to a dead_letter table,
+# so one bad row never holds up the rows behind it.
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List
+from sofar_metrics import metrics
+
+BUFFER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sofar_buffer.db')  # Next to the scripts
+FORWARD_BATCH = 2000   # Rows per MySQL round trip while draining
+RETRY_DELAY = 5        # Seconds before retrying an unreachable database
+MAX_RETRY_DELAY = 300
+FORWARD_SINK = 'BufferSink.forward'  # Sink label of the MySQL writes in the metrics
+# Errors that say nothing about the rows: connection refused/lost (client codes 2000+),
+# too many connections, access denied, server shutdown, lock wait timeout, deadlock
+TRANSIENT_ERRORS = (1040, 1044, 1045, 1053, 1205, 1213)
+
+IDENTITY_COLUMNS = ('timestamp', 'sample_key', 'port', 'unit_id', 'section')
+
+def sample_key(row: Dict[str, Any], timestamp: str) -> str:
+    # The column set is part of the key: swinging-door points (sofar_deadband) arrive
+    # later as a second row for an earlier poll and section, and must not be ignored
+    columns = sorted(name for name in row if name not in IDENTITY_COLUMNS)
+    identity = [timestamp, row.get('port'), row.get('unit_id'), row.get('section'), columns]
+    return hashlib.sha1(json.dumps(identity).encode('utf-8')).hexdigest()
+
+def is_transient(error: Exception) -> bool:
+    import pymysql
+
+    if not isinstance(error, pymysql.err.MySQLError) or isinstance(error, pymysql.err.InterfaceError):
+        return True
+    code = error.args[0] if error.args and isinstance(error.args[0], int) else 0
+    return code >= 2000 or code in TRANSIENT_ERRORS
+
+class BufferSink:
+    def __init__(self, path: str = BUFFER_FILE, forward: bool = True):
+        self.path = path
+        self.connection = self._connect()
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS samples (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sample_key TEXT UNIQUE NOT NULL,
+                row TEXT NOT NULL
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS dead_letter (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sample_key TEXT NOT NULL,
+                row TEXT NOT NULL,
+                error TEXT NOT NULL,
+                failed_at TEXT NOT NULL
+            )""")
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.forwarder = None
+        if forward:
+            self.forwarder = threading.Thread(target=self._forward_loop, name='buffer-forwarder', daemon=True)
+            self.forwarder.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def write(self, rows: List[Dict[str, Any]], timestamp: str = None):
+        timestamp = timestamp or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        records = []
+        for row in rows:
+            key = sample_key(row, timestamp)
+            records.append((key, json.dumps(dict(row, timestamp=timestamp, sample_key=key))))
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("INSERT OR IGNORE INTO samples (sample_key, row) VALUES (?, ?)", records)
+            self.connection.execute("COMMIT")
+        self.wakeup.set()
+        return len(records)
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+
+    def dead_letters(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+
+    def _write_or_split(self, db_sink, rows: List[Dict[str, Any]], rejected: list):
+        """Write rows, halving the batch on errors about its content until the bad rows are found."""
+        started = time.monotonic()
+        try:
+            count = db_sink.write(rows)  # Commits; duplicates of a re-sent batch are ignored
+        except Exception as e:
+            if metrics.enabled:
+                metrics.inc('sofar_db_errors_total', sink=FORWARD_SINK)
+            if is_transient(e):
+                raise
+            if len(rows) == 1:
+                logging.error(f"MySQL rejected buffered row {rows[0].get('sample_key')}, "
+                              f"moved to dead_letter: {e}")
+                rejected.append((rows[0], str(e)))
+                if metrics.enabled:
+                    metrics.inc('sofar_db_dead_letters_total')
+                return
+            middle = len(rows) // 2
+            self._write_or_split(db_sink, rows[:middle], rejected)
+            self._write_or_split(db_sink, rows[middle:], rejected)
+            return
+        if metrics.enabled:
+            metrics.observe('sofar_db_write_seconds', time.monotonic() - started, sink=FORWARD_SINK)
+            metrics.inc('sofar_db_rows_total', count or 0, sink=FORWARD_SINK)
+
+    def forward(self, db_sink, batch_size: int = FORWARD_BATCH) -> int:
+        """Drain the buffer to MySQL, returns the number of rows forwarded."""
+        forwarded = 0
+        while True:
+            with self.lock:
+                batch = self.connection.execute(
+                    "SELECT id, row FROM samples ORDER BY id LIMIT ?", (batch_size,)).fetchall()
+            if not batch:
+                break
+
+            # Rows of one batch can have different columns, insert them per column set
+            groups = {}
+            for _, row in batch:
+                row = json.loads(row)
+                groups.setdefault(tuple(row), []).append(row)
+            rejected = []
+            for rows in groups.values():
+                self._write_or_split(db_sink, rows, rejected)
+
+            failed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            with self.lock:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(
+                    "INSERT INTO dead_letter (sample_key, row, error, failed_at) VALUES (?, ?, ?, ?)",
+                    [(row.get('sample_key', ''), json.dumps(row), error, failed_at) for row, error in rejected])
+                self.connection.execute("DELETE FROM samples WHERE id <= ?", (batch[-1][0],))
+                self.connection.execute("COMMIT")
+            forwarded += len(batch) - len(rejected)
+        return forwarded
+
+    def _forward_loop(self):
+        from sofar_pipeline import DbSink
+
+        db_sink = None
+        delay = RETRY_DELAY
+        while not self.stopped.is_set():
+            try:
+                if db_sink is None:
+                    db_sink = DbSink()
+                started = time.monotonic()
+                forwarded = self.forward(db_sink)
+                if forwarded:
+                    logging.info(f"Forwarded {forwarded} buffered rows in {time.monotonic() - started:.1f}s")
+                delay = RETRY_DELAY
+                self.wakeup.wait(RETRY_DELAY)
+                self.wakeup.clear()
+            except Exception as e:
+                logging.error(f"Forwarding buffered rows failed, retrying in {delay}s: {e}")
+                if db_sink is not None:
+                    try:
+                        db_sink.close()
+                    except Exception:
+                        pass
+                    db_sink = None
+                self.stopped.wait(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+        # Last drain on shutdown, whatever is left stays buffered for the next run
+        try:
+            if self.pending():
+                db_sink = db_sink or DbSink()
+                self.forward(db_sink)
+        except Exception as e:
+            logging.error(f"Final forward failed, {self.pending()} rows stay buffered: {e}")
+        finally:
+            if db_sink is not None:
+                db_sink.close()
+
+    def close(self, timeout: float = 30):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.forwarder is not None:
+            self.forwarder.join(timeout)
+            if self.forwarder.is_alive():
+                return  # Still draining a large backlog, the rows are safe in the WAL
+        self.connection.close()
+
+def main():
+    # Drain whatever is buffered and exit, e.g. from cron after an outage
+    from sofar_pipeline import DbSink
+
+    buffer = BufferSink(forward=False)
+    db_sink = DbSink()
+    try:
+        print(f"{buffer.pending()} rows buffered, {buffer.dead_letters()} in dead_letter")
+        started = time.monotonic()
+        forwarded = buffer.forward(db_sink)
+        print(f"Forwarded {forwarded} rows in {time.monotonic() - started:.1f}s")
+    finally:
+        db_sink.close()
+        buffer.close()
+
+if __name__ == "__main__":
+    main()
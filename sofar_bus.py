@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# sofar_bus.py
+#
+# Block reads with an adaptive timeout per block, bounded retries with
+# backoff for timeouts/CRC errors, and no retry for Modbus exception
+# responses. Failures are remembered so the read planner stops asking for
+# blocks that always fail.
+
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+from sofar_metrics import metrics, block_label, error_kind
+
+TIMEOUT = 1            # Used until a block has a measured round-trip time
+MIN_TIMEOUT = 0.15
+MAX_TIMEOUT = 2.0
+TIMEOUT_FACTOR = 3     # Timeout = smoothed round-trip time x factor
+RTT_SMOOTHING = 0.2    # Weight of the newest round-trip sample
+RETRIES = 2            # Extra attempts after a timeout or CRC error
+BACKOFF = 0.05         # Seconds before the first retry, doubled per attempt
+FAIL_LIMIT = 3         # Consecutive timeouts before a block counts as bad
+RECHECK_AFTER = 3600   # Seconds before a bad block or dead register is tried again
+
+ILLEGAL_ADDRESS = 2
+
+class BlockFailures:
+    """What the planner should stop asking for."""
+
+    def __init__(self, recheck_after: float = RECHECK_AFTER):
+        self.recheck_after = recheck_after
+        self.bad_blocks: Dict[Tuple[int, int], float] = {}  # (start, count) refused or never answered
+        self.dead: Dict[int, float] = {}                    # Registers that fail even on their own
+
+    def _current(self, failures: dict, key) -> bool:
+        failed_at = failures.get(key)
+        if failed_at is None:
+            return False
+        if time.monotonic() - failed_at > self.recheck_after:
+            del failures[key]  # Firmware or wiring may have changed, give it another chance
+            return False
+        return True
+
+    def block_failed(self, start_address: int, count: int) -> bool:
+        return self._current(self.bad_blocks, (start_address, count))
+
+    def is_dead(self, address: int) -> bool:
+        return self._current(self.dead, address)
+
+    def mark_bad(self, start_address: int, count: int):
+        self.bad_blocks[(start_address, count)] = time.monotonic()
+
+    def mark_dead(self, address: int):
+        self.dead[address] = time.monotonic()
+
+def set_timeout(client, timeout: float):
+    # pymodbus keeps the serial timeout in comm_params, pyserial applies it to the open port
+    params = getattr(client, 'comm_params', None)
+    if params is not None and hasattr(params, 'timeout_connect'):
+        params.timeout_connect = timeout
+    socket = getattr(client, 'socket', None)
+    if socket is not None and hasattr(socket, 'timeout'):
+        socket.timeout = timeout
+
+class BlockReader:
+    """Callable read_block(start_address, count) for one unit on one client."""
+
+    def __init__(self, client, unit_id: int, timeout: float = TIMEOUT, retries: int = RETRIES):
+        self.client = client
+        self.unit_id = unit_id
+        self.default_timeout = timeout
+        self.retries = retries
+        self.rtt: Dict[Tuple[int, int], float] = {}
+        self.timeouts: Dict[Tuple[int, int], int] = {}
+        self.failures = BlockFailures()
+        self.current_timeout = None
+
+    def timeout_for(self, block: Tuple[int, int]) -> float:
+        rtt = self.rtt.get(block)
+        if rtt is None:
+            return self.default_timeout
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, rtt * TIMEOUT_FACTOR))
+
+    def _apply_timeout(self, timeout: float):
+        if timeout != self.current_timeout:
+            set_timeout(self.client, timeout)
+            self.current_timeout = timeout
+
+    def __call__(self, start_address: int, count: int) -> Optional[List[int]]:
+        block = (start_address, count)
+        timeout = self.timeout_for(block)
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                if metrics.enabled:
+                    metrics.inc('sofar_request_retries_total', block=block_label(start_address, count))
+                time.sleep(BACKOFF * 2 ** (attempt - 1))
+                timeout = min(MAX_TIMEOUT, timeout * 2)  # The device may just be slow right now
+            self._apply_timeout(timeout)
+
+            started = time.monotonic()
+            try:
+                result = self.client.read_holding_registers(start_address, count, slave=self.unit_id)
+            except Exception as e:
+                logging.error(f"Exception reading registers at address 0x{start_address:04X}: {e}")
+                if metrics.enabled:
+                    metrics.inc('sofar_request_errors_total', block=block_label(start_address, count),
+                                kind=error_kind(e))
+                continue
+            elapsed = time.monotonic() - started
+
+            if not result.isError():
+                if metrics.enabled:
+                    metrics.observe('sofar_request_seconds', elapsed, block=block_label(start_address, count))
+                previous = self.rtt.get(block)
+                self.rtt[block] = elapsed if previous is None else previous + RTT_SMOOTHING * (elapsed - previous)
+                self.timeouts.pop(block, None)
+                self.failures.bad_blocks.pop(block, None)
+                return result.registers
+
+            exception_code = getattr(result, 'exception_code', None)
+            if exception_code is not None:
+                # The device answered with a Modbus exception, asking again won't change that
+                logging.error(f"Modbus exception {exception_code} reading 0x{start_address:04X}+{count}")
+                if metrics.enabled:
+                    metrics.inc('sofar_request_errors_total', block=block_label(start_address, count),
+                                kind=f"exception{exception_code}")
+                if exception_code == ILLEGAL_ADDRESS:
+                    self.failures.mark_bad(start_address, count)
+                return None
+
+            logging.error(f"Error reading registers at address 0x{start_address:04X}: {result}")
+            if metrics.enabled:
+                metrics.inc('sofar_request_errors_total', block=block_label(start_address, count),
+                            kind=error_kind(result))
+
+        # Timed out or garbled on every attempt
+        self.timeouts[block] = self.timeouts.get(block, 0) + 1
+        if self.timeouts[block] >= FAIL_LIMIT:
+            self.failures.mark_bad(start_address, count)
+        return None
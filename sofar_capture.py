@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+# sofar_capture.py
+#
+# Append-only capture of the raw 16-bit words of every polled block, so a
+# fixed sofarregister.csv can be re-applied to history later.
+#
+# File layout: MAGIC, then records of
+#   <timestamp: float64 LE> <start address: u16 LE> <count: u16 LE> <count x u16 BE words>
+# All blocks of one poll cycle share the cycle's timestamp.
+#
+# Usage: sofar_capture.py CAPTURE [--pivot-csv FILE] [--pivoted FILE] [--db]
+
+import os
+import sys
+import csv
+import struct
+import logging
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+MAGIC = b'SOFCAP1\n'
+RECORD_HEADER = struct.Struct('<dHH')
+CSV_FILE = 'sofarregister.csv'
+MAX_REGISTER = 0x1324
+
+class CaptureWriter:
+    def __init__(self, path: str):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if new_file:
+            self.file.write(MAGIC)
+
+    def write_block(self, timestamp: float, start_address: int, registers: List[int]):
+        self.file.write(RECORD_HEADER.pack(timestamp, start_address, len(registers)))
+        self.file.write(struct.pack(f'>{len(registers)}H', *registers))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def capturing(read_block: Callable[[int, int], Optional[List[int]]], writer: CaptureWriter,
+              timestamp: float) -> Callable[[int, int], Optional[List[int]]]:
+    """Wrap a block reader so every successful read is also written to the capture."""
+    def read_and_capture(start_address, count):
+        registers = read_block(start_address, count)
+        if registers:
+            writer.write_block(timestamp, start_address, registers)
+        return registers
+    return read_and_capture
+
+def iter_blocks(path: str) -> Iterator[Tuple[float, int, Tuple[int, ...]]]:
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a register capture")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            timestamp, start_address, count = RECORD_HEADER.unpack(header)
+            data = f.read(count * 2)
+            if len(data) < count * 2:
+                logging.warning(f"Truncated record at 0x{start_address:04X} in {path}")
+                break
+            yield timestamp, start_address, struct.unpack(f'>{count}H', data)
+
+def iter_cycles(path: str) -> Iterator[Tuple[float, Dict[int, Tuple[int, ...]]]]:
+    cycle_timestamp, blocks = None, {}
+    for timestamp, start_address, registers in iter_blocks(path):
+        if timestamp != cycle_timestamp and blocks:
+            yield cycle_timestamp, blocks
+            blocks = {}
+        cycle_timestamp = timestamp
+        blocks[start_address] = registers
+    if blocks:
+        yield cycle_timestamp, blocks
+
+def load_images(path: str, word_count: int = MAX_REGISTER + 1):
+    """Stack every cycle into (timestamps, images, valid) arrays starting at address 0."""
+    import numpy as np
+
+    cycles = list(iter_cycles(path))
+    images = np.zeros((len(cycles), word_count), dtype=np.uint16)
+    valid = np.zeros((len(cycles), word_count), dtype=bool)
+    for row, (_, blocks) in enumerate(cycles):
+        for start_address, registers in blocks.items():
+            end_address = min(start_address + len(registers), word_count)
+            if start_address < end_address:
+                images[row, start_address:end_address] = registers[:end_address - start_address]
+                valid[row, start_address:end_address] = True
+    return [timestamp for timestamp, _ in cycles], images, valid
+
+def decode_capture(path: str, csv_file: str = CSV_FILE):
+    from sofar_batch import decode_images
+    from sofar_registers import load_register_map
+
+    register_map = load_register_map(csv_file, MAX_REGISTER)
+    timestamps, images, valid = load_images(path)
+    return register_map, timestamps, decode_images(register_map, 0, images, valid)
+
+def format_timestamp(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} CAPTURE [--pivot-csv FILE] [--pivoted FILE] [--db]", file=sys.stderr)
+        return
+    args = sys.argv[2:]
+    register_map, timestamps, columns = decode_capture(sys.argv[1])
+    print(f"Decoded {len(timestamps)} cycles, {len(columns)} registers")
+
+    if '--pivot-csv' in args:
+        # Same layout as sofar_pivot.py: Timestamp plus "name (unit)" columns
+        import pandas as pd
+        from sofar_batch import column_names
+        units = {name: register_map[start].unit for start, name in column_names(register_map).items()}
+        df = pd.DataFrame({f"{name} ({units[name]})": values for name, values in columns.items()})
+        df.insert(0, 'Timestamp', [format_timestamp(t) for t in timestamps])
+        df.to_csv(args[args.index('--pivot-csv') + 1], index=False)
+
+    if '--pivoted' in args:
+        # Same layout as read.py's /tmp/pivoted_registers.csv, ready for pivot2db.py
+        from read import pivot_registers
+        pivoted = pivot_registers(columns)
+        pivoted.to_csv(args[args.index('--pivoted') + 1], index=False, quoting=csv.QUOTE_NONNUMERIC)
+
+    if '--db' in args:
+        from db_config import get_db_connection
+        from pivot2db import insert_checked, insert_columns, load_schema_cache, truncate_column_name
+        table_name = 'inverter_data'
+        connection = get_db_connection()
+        try:
+            with connection.cursor() as cursor:
+                insert_checked(cursor, table_name, [truncate_column_name(name) for name in columns],
+                               load_schema_cache(),
+                               lambda: insert_columns(cursor, table_name, columns,
+                                                      [format_timestamp(t) for t in timestamps]))
+            connection.commit()
+        finally:
+            connection.close()
+
+if __name__ == "__main__":
+    main()
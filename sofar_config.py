@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+# sofar_config.py
+#
+# Snapshots of the setting registers (0x0800-0x1324). The raw words of every
+# 64-address section are hashed; a snapshot and the diff to the previous one
+# are stored only when the hash changes, and the words themselves are stored
+# once per distinct hash. settings_at(T) answers from the newest snapshot per
+# section at or before T.
+#
+# Usage: sofar_config.py [--at "YYYY-mm-dd HH:MM:SS"] [--history]
+
+import sys
+import json
+import struct
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+from typing import Any, Dict, List
+
+SNAPSHOT_DB = '/home/pi/python/sofar_config.db'
+CONFIG_START = 0x0800
+CONFIG_END = 0x1324
+SECTION_SIZE = 64  # Addresses covered by one AddressMask register
+
+def section_start(address: int) -> int:
+    return address - address % SECTION_SIZE
+
+def pack_section(words: Dict[int, List[int]]) -> bytes:
+    # Address and width before each register's words, so the blob can be decoded on its own
+    return b''.join(struct.pack(f'>HB{len(registers)}H', address, len(registers), *registers)
+                    for address, registers in sorted(words.items()))
+
+def unpack_section(blob: bytes) -> Dict[int, List[int]]:
+    words = {}
+    offset = 0
+    while offset < len(blob):
+        address, width = struct.unpack_from('>HB', blob, offset)
+        words[address] = list(struct.unpack_from(f'>{width}H', blob, offset + 3))
+        offset += 3 + 2 * width
+    return words
+
+class ConfigSnapshots:
+    def __init__(self, register_map, path: str = SNAPSHOT_DB):
+        self.register_map = register_map
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                words BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                section TEXT NOT NULL,
+                taken_at TEXT NOT NULL,
+                hash TEXT NOT NULL REFERENCES blobs(hash),
+                diff TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS snapshots_section_time ON snapshots (section, taken_at);
+        """)
+        self.lock = threading.Lock()
+        # Newest hash per section, so an unchanged read costs one SHA-1 and no query
+        self.current = dict(self.connection.execute("""
+            SELECT section, hash FROM snapshots s
+            WHERE id = (SELECT MAX(id) FROM snapshots WHERE section = s.section)""").fetchall())
+
+    def section_name(self, start: int) -> str:
+        mask = self.register_map.get(start)
+        if mask is not None and mask.name.lower().startswith('addressmask'):
+            return mask.name
+        return f"0x{start:04X}"
+
+    def decode(self, words: Dict[int, List[int]]) -> Dict[str, Any]:
+        values = {}
+        for address, registers in words.items():
+            register = self.register_map.get(address)
+            if register is not None and register.name:
+                values[register.name] = register.decode(registers)
+        return values
+
+    def _words(self, digest: str) -> Dict[int, List[int]]:
+        row = self.connection.execute("SELECT words FROM blobs WHERE hash = ?", (digest,)).fetchone()
+        return unpack_section(row[0]) if row else {}
+
+    def record(self, words: Dict[int, List[int]], timestamp: str = None) -> List[str]:
+        """Store the sections whose raw words changed, returns their names."""
+        timestamp = timestamp or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        sections = {}
+        for address, registers in words.items():
+            sections.setdefault(section_start(address), {})[address] = registers
+
+        changed = []
+        with self.lock:
+            for start, section_words in sorted(sections.items()):
+                name = self.section_name(start)
+                blob = pack_section(section_words)
+                digest = hashlib.sha1(blob).hexdigest()
+                previous = self.current.get(name)
+                if digest == previous:
+                    continue
+
+                previous_words = self._words(previous) if previous else {}
+                if previous_words.keys() - section_words.keys():
+                    # A block timed out this cycle: its registers keep their last known words,
+                    # a partial read is neither a change nor a reason to forget settings
+                    section_words = {**previous_words, **section_words}
+                    blob = pack_section(section_words)
+                    digest = hashlib.sha1(blob).hexdigest()
+                    if digest == previous:
+                        continue
+
+                old = self.decode(previous_words)
+                new = self.decode(section_words)
+                diff = {key: [old.get(key), value] for key, value in new.items() if old.get(key) != value}
+
+                self.connection.execute("BEGIN")
+                self.connection.execute("INSERT OR IGNORE INTO blobs (hash, words) VALUES (?, ?)", (digest, blob))
+                self.connection.execute("INSERT INTO snapshots (section, taken_at, hash, diff) VALUES (?, ?, ?, ?)",
+                                        (name, timestamp, digest, json.dumps(diff, ensure_ascii=False)))
+                self.connection.execute("COMMIT")
+                self.current[name] = digest
+                changed.append(name)
+        return changed
+
+    def settings_at(self, timestamp: str) -> Dict[str, Any]:
+        """Every setting as it was at timestamp ('YYYY-mm-dd HH:MM:SS')."""
+        with self.lock:
+            rows = self.connection.execute("""
+                SELECT hash FROM snapshots s
+                WHERE id = (SELECT id FROM snapshots WHERE section = s.section AND taken_at <= ?
+                            ORDER BY taken_at DESC, id DESC LIMIT 1)""", (timestamp,)).fetchall()
+            settings = {}
+            for (digest,) in rows:
+                settings.update(self.decode(self._words(digest)))
+        return settings
+
+    def history(self, section: str = None) -> List[tuple]:
+        """(taken_at, section, diff) for every stored change, oldest first."""
+        query = "SELECT taken_at, section, diff FROM snapshots"
+        params = ()
+        if section:
+            query += " WHERE section = ?"
+            params = (section,)
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY taken_at, id", params).fetchall()
+        return [(taken_at, name, json.loads(diff)) for taken_at, name, diff in rows]
+
+    def close(self):
+        self.connection.close()
+
+def main():
+    from read import CSV_FILE, read_register_map_from_csv
+
+    snapshots = ConfigSnapshots(read_register_map_from_csv(CSV_FILE))
+    try:
+        if '--history' in sys.argv:
+            for taken_at, section, diff in snapshots.history():
+                print(f"{taken_at} {section}: {len(diff)} changed")
+                for name, (old, new) in diff.items():
+                    print(f"    {name}: {old} -> {new}")
+        else:
+            at = sys.argv[sys.argv.index('--at') + 1] if '--at' in sys.argv else datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            for name, value in snapshots.settings_at(at).items():
+                print(f"{name}: {value}")
+    finally:
+        snapshots.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+# sofar_control.py
+#
+# Priority write path for the remote control registers (0x1104-0x11FF:
+# Remote_On_Off_Control, Active_Power_Export_Limit, Energy_Storage_Mode_Control,
+# Passive_Manual_* ...). A BusScheduler owns the bus and runs one request at a
+# time from a priority queue, so a write waits at most for the read already on
+# the wire, never for the rest of a sweep. Values are encoded from the register
+# map, every write is confirmed by reading it back, and the time from the API
+# call to the confirmed write is measured.
+#
+# sofar_daemon.py --control serves POST /write on CONTROL_PORT: 200 confirmed,
+# 400 bad request, 502 not written, 504 sent but unconfirmed (outcome unknown).
+# This script sends one write to it and exits 0, 1 or (outcome unknown) 3:
+#
+# Usage: sofar_control.py [--url http://127.0.0.1:9106] REGISTER VALUE
+
+import sys
+import json
+import time
+import queue
+import logging
+import itertools
+import threading
+import urllib.request
+import urllib.error
+from concurrent.futures import Future, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Tuple
+from sofar_metrics import metrics
+from sofar_registers import encode_value
+
+CONTROL_PORT = 9106
+CONTROL_URL = f"http://127.0.0.1:{CONTROL_PORT}"
+WRITE_TIMEOUT = 2.0     # Seconds an API call waits for a confirmed write
+WRITABLE = (0x1104, 0x11FF)  # The Config_Remote sections
+
+# Typed rows of the Config_Remote sections that are documented settings. Reserved
+# (*_Rsvd*) and untyped rows, which the map parses as U16, are never written.
+CONTROL_REGISTERS = frozenset((
+    'Remote_On_Off_Control', 'Power_Control', 'Active_Power_Export_Limit', 'Active_Power_Import_Limit',
+    'Reactive_Power_Setting', 'Power_Factor_Setting', 'Active_Power_Limit_Speed',
+    'Reactive_Power_Response_Time', 'SVG_Fixed_Reactive_Power_Setting',
+    'Energy_Storage_Mode_Control',
+    'Timing_ID', 'Timing_On_Off_Control', 'Timing_Charge_Start', 'Timing_Charge_End',
+    'Timing_Discharge_Start', 'Timing_Discharge_End', 'Timing_Power_Charge', 'Timing_Power_Discharge',
+    'Timing_Control',
+    'TOU_ID', 'TOU_On_Off_Control', 'TOU_Charge_Start', 'TOU_Charge_End', 'TOU_Charge_Target_SOC',
+    'TOU_Charge_Power', 'TOU_Executed_Date_Start', 'TOU_Executed_Date_End', 'TOU_Executed_Day_of_Week',
+    'TOU_Control',
+    'Peak_Shaving_Discharge_Threshold', 'Peak_Shaving_Charge_Threshold',
+    'Off_Grid_Charge_Source', 'Off_Grid_Grid_Power', 'Off_Grid_DG_Power',
+    'Passive_Timeout', 'Passive_Timeout_Action',
+    'Passive_Manual_Gdes', 'Passive_Manual_Blo', 'Passive_Manual_Bup', 'Passive_Manual_Gdzup',
+    'Passive_Manual_Gdzlo',
+    'Passive_Scheduler_Gdes_Ante', 'Passive_Scheduler_Blo_Ante', 'Passive_Scheduler_Bup_Ante',
+    'Passive_Scheduler_Gdzup_Ante', 'Passive_Scheduler_Gdzlo_Ante',
+    'Passive_Scheduler_Gdes_Post', 'Passive_Scheduler_Blo_Post', 'Passive_Scheduler_Bup_Post',
+    'Passive_Scheduler_Gdzup_Post', 'Passive_Scheduler_Gdzlo_Post',
+    'Passive_Scheduler_StartTime', 'Passive_Scheduler_DurationTime', 'Passive_Scheduler_ManagementMode',
+    'CommBreak_Protect_Enable', 'CommBreak_Recovery_Mode', 'CommBreak_Threshold_Time',
+    'CommBreak_Mode_Judge', 'CommBreak_Alarm_Clear',
+))
+
+WRITE_PRIORITY = 0
+READ_PRIORITY = 1
+STOP_PRIORITY = 2
+
+class WriteError(Exception):
+    pass
+
+class WriteUnconfirmed(WriteError):
+    """The write went out but was not confirmed in time, it may still have landed."""
+
+class BusScheduler:
+    """Owns the bus: a worker thread runs queued requests one at a time, writes first.
+
+    Also a read_block callable, so the pollers queue their reads behind any writes.
+    """
+
+    def __init__(self, client, reader, unit_id: int):
+        self.client = client
+        self.reader = reader
+        self.unit_id = unit_id
+        self.jobs = queue.PriorityQueue()
+        self.sequence = itertools.count()  # FIFO within a priority
+        self.thread = threading.Thread(target=self.run, name='bus-scheduler', daemon=True)
+        self.thread.start()
+
+    @property
+    def failures(self):
+        return self.reader.failures
+
+    def submit(self, priority: int, job: Callable[[], Any]) -> Future:
+        future = Future()
+        self.jobs.put((priority, next(self.sequence), job, future))
+        return future
+
+    def run(self):
+        while True:
+            priority, _, job, future = self.jobs.get()
+            if job is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue  # The caller gave up before the request went out
+            try:
+                future.set_result(job())
+            except Exception as e:
+                future.set_exception(e)
+
+    def __call__(self, start_address: int, count: int):
+        return self.submit(READ_PRIORITY, lambda: self.reader(start_address, count)).result()
+
+    def write(self, register, words: List[int]) -> Future:
+        return self.submit(WRITE_PRIORITY, lambda: self._write(register, words))
+
+    def _write(self, register, words: List[int]) -> List[int]:
+        result = self.client.write_registers(register.start, words, slave=self.unit_id)
+        if result.isError():
+            raise WriteError(f"{register.name}: write refused: {result}")
+        readback = self.reader(register.start, register.width)
+        if readback != words:
+            raise WriteError(f"{register.name}: wrote {words}, read back {readback}")
+        return readback
+
+    def close(self):
+        self.jobs.put((STOP_PRIORITY, next(self.sequence), None, None))
+        self.thread.join()
+
+def find_register(register_map, target):
+    """Register by name, ADDR_Name column name or hex address."""
+    text = str(target).strip()
+    prefix, _, rest = text.partition('_')
+    for candidate in (text, rest if len(prefix) == 4 else None):
+        for register in register_map:
+            if candidate and register.name == candidate:
+                return register
+    try:
+        return register_map.get(int(text, 16))
+    except ValueError:
+        return None
+
+def encode_control(register_map, target, value) -> Tuple[Any, List[int]]:
+    register = find_register(register_map, target)
+    if register is None or not register.name:
+        raise ValueError(f"Unknown register {target}")
+    if not WRITABLE[0] <= register.start <= WRITABLE[1] or register.name not in CONTROL_REGISTERS:
+        raise ValueError(f"{register.name} is not a control register")
+    words = None if register.type == 'ASCII' else encode_value(register, value)
+    # Decoding the words again catches values the register type cannot hold
+    if not words or abs(register.decode(words) - float(value)) > register.scale / 2:
+        raise ValueError(f"{value} does not fit {register.name} ({register.type}, scale {register.scale})")
+    return register, words
+
+class Controller:
+    """The write API: encode, queue ahead of reads, wait for the read-back."""
+
+    def __init__(self, scheduler: BusScheduler, register_map):
+        self.scheduler = scheduler
+        self.register_map = register_map
+
+    def write(self, target, value, timeout: float = WRITE_TIMEOUT) -> Dict[str, Any]:
+        started = time.monotonic()
+        register, words = encode_control(self.register_map, target, value)
+        future = self.scheduler.write(register, words)
+        try:
+            future.result(timeout)
+        except TimeoutError:
+            # Cancelling only works while the write is still queued, one on the wire completes
+            if future.cancel():
+                raise WriteError(f"{register.name}: not sent within {timeout}s, bus busy")
+            raise WriteUnconfirmed(f"{register.name}: sent but not confirmed within {timeout}s, "
+                                   f"read it back before retrying")
+        except WriteError:
+            raise
+        except Exception as e:
+            raise WriteError(f"{register.name}: {e}") from e
+        latency = time.monotonic() - started
+        if metrics.enabled:
+            metrics.observe('sofar_write_seconds', latency, register=register.name)
+        logging.info(f"Wrote {register.name} = {value} ({words}) in {latency:.3f}s")
+        return {'register': register.name, 'address': f"0x{register.start:04X}", 'value': value,
+                'words': words, 'latency': round(latency, 4)}
+
+class ControlHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/write':
+            return self.reply(404, {'error': 'not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            result = self.server.controller.write(request['register'], request['value'],
+                                                  float(request.get('timeout', WRITE_TIMEOUT)))
+        except (ValueError, KeyError, TypeError, OverflowError) as e:
+            return self.reply(400, {'error': str(e)})
+        except WriteUnconfirmed as e:
+            logging.error(f"Control write outcome unknown: {e}")
+            return self.reply(504, {'error': str(e), 'outcome': 'unknown'})
+        except WriteError as e:
+            logging.error(f"Control write failed: {e}")
+            return self.reply(502, {'error': str(e), 'outcome': 'failed'})
+        self.reply(200, result)
+
+    def reply(self, status: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_control(controller: Controller, port: int = CONTROL_PORT, host: str = '127.0.0.1'):
+    # Localhost only: anyone who can reach this port can switch the inverter off
+    server = ThreadingHTTPServer((host, port), ControlHandler)
+    server.controller = controller
+    threading.Thread(target=server.serve_forever, name='control-http', daemon=True).start()
+    logging.info(f"Control writes on http://{host}:{port}/write")
+    return server
+
+def main():
+    args = sys.argv[1:]
+    url = args[args.index('--url') + 1] if '--url' in args else CONTROL_URL
+    positional = [arg for i, arg in enumerate(args) if not arg.startswith('--') and (i == 0 or args[i - 1] != '--url')]
+    if len(positional) != 2:
+        print("Usage: sofar_control.py [--url URL] REGISTER VALUE", file=sys.stderr)
+        sys.exit(2)
+
+    register, value = positional
+    request = urllib.request.Request(f"{url}/write", json.dumps({'register': register, 'value': value}).encode(),
+                                     {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=WRITE_TIMEOUT + 5) as response:
+            result = json.load(response)
+    except urllib.error.HTTPError as e:
+        # 504: the write was sent and may have landed, 4xx/502: it did not
+        status = "Write outcome unknown" if e.code == 504 else "Write failed"
+        print(f"{status}: {json.load(e).get('error')}", file=sys.stderr)
+        sys.exit(3 if e.code == 504 else 1)
+    except (urllib.error.URLError, TimeoutError) as e:
+        print(f"Cannot reach {url}, is sofar_daemon.py --control running? {getattr(e, 'reason', e)}",
+              file=sys.stderr)
+        sys.exit(1)
+    print(f"{result['register']} ({result['address']}) = {result['value']}, confirmed in {result['latency']}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# sofar_daemon.py
+#
+# Long-running poller: keeps the serial connection and the register map
+# loaded and polls every register group on its own schedule.
+
+import sys
+import time
+import logging
+from pymodbus.client.serial import ModbusSerialClient
+from read import (SERIAL_PORT, BAUD_RATE, UNIT_ID, CSV_FILE, TIMEOUT, BLOCK_SIZE, GAP_TOLERANCE,
+                  read_register_map_from_csv)
+from sofar_bus import BlockReader
+from sofar_deadband import Deadband
+from sofar_config import ConfigSnapshots, section_start
+from sofar_metrics import metrics, enable_from_argv
+from sofar_profile import apply_profile, load_profile, profile_baudrate, profile_masks, profile_max_words
+from sofar_pipeline import QueuedSink, make_sinks
+from sofar_proxy import PROXY_PORT, RegisterImage, planned_blocks, start_proxy
+from sofar_control import READ_PRIORITY, BusScheduler, Controller, serve_control
+from read_planner import apply_address_masks, mask_addresses, read_address_masks, read_planned
+
+RECONNECT_DELAY = 10  # Seconds to wait before reopening a lost serial port
+
+# (group, first address, last address, interval in seconds or None for once at startup)
+SCHEDULES = [
+    ('version', 0x0440, 0x046C, None),
+    ('realtime', 0x0480, 0x06BF, 5),
+    ('config', 0x0800, 0x1324, 3600),
+]
+
+def group_spans(register_map, start, end, masks, profile=None):
+    spans = [(register.start, register.width)
+             for register in register_map.between(start, end) if register.name]
+    return apply_profile(apply_address_masks(spans, masks), profile)
+
+def read_group(reader, spans, max_words=BLOCK_SIZE):
+    return read_planned(reader, spans, GAP_TOLERANCE, max_words, reader.failures)
+
+def decode_group(register_map, words):
+    started = time.monotonic()
+    register_data = []
+    for address, registers in words.items():
+        info = register_map[address]
+        value = info.decode(registers)
+        if value is not None:
+            register_data.append({
+                'section': info.section,
+                'name': info.name,
+                'value': value,
+                'unit': info.unit
+            })
+    if metrics.enabled:
+        metrics.observe('sofar_decode_seconds', time.monotonic() - started)
+    return register_data
+
+def poll_group(reader, register_map, spans, max_words=BLOCK_SIZE):
+    return decode_group(register_map, read_group(reader, spans, max_words))
+
+def changed_samples(deadband, register_data, now):
+    # Deadband-filtered samples grouped by timestamp, swinging-door points can be from an earlier poll
+    by_name = {sample['name']: sample for sample in register_data}
+    points, _ = deadband.update({name: sample['value'] for name, sample in by_name.items()}, now)
+    batches = {}
+    for timestamp, name, value in points:
+        batches.setdefault(timestamp, []).append(dict(by_name[name], value=value))
+    return sorted(batches.items())
+
+def connect(client):
+    while not client.connect():
+        logging.error(f"Failed to connect to the inverter, retrying in {RECONNECT_DELAY}s")
+        time.sleep(RECONNECT_DELAY)
+
+def reconnect(client, reader):
+    # Whoever owns the bus has to be idle while the port is reopened
+    if isinstance(reader, RegisterImage):
+        with reader.lock:
+            reconnect(client, reader.reader)
+    elif isinstance(reader, BusScheduler):
+        reader.submit(READ_PRIORITY, lambda: connect(client)).result()
+    else:
+        connect(client)
+
+def main():
+    # --metrics-port / --metrics-file turn the instrumentation on
+    enable_from_argv(sys.argv)
+    profile = load_profile(SERIAL_PORT, UNIT_ID)
+    client = ModbusSerialClient(method='rtu', port=SERIAL_PORT, baudrate=profile_baudrate(profile, BAUD_RATE),
+                                parity='N', stopbits=1, bytesize=8, timeout=TIMEOUT)
+    connect(client)
+
+    # Everything after the port is open runs inside the try, a sink or snapshot store
+    # that cannot be opened must not leave the serial port open
+    sinks = snapshots = None
+    try:
+        register_map = read_register_map_from_csv(CSV_FILE)
+        # Adaptive timeouts and failed-block memory live as long as the daemon
+        reader = BlockReader(client, UNIT_ID, TIMEOUT)
+        masks = profile_masks(profile)
+        if masks is None:
+            masks = read_address_masks(reader, mask_addresses(register_map))
+        max_words = profile_max_words(profile, BLOCK_SIZE)
+        if '--control' in sys.argv:
+            # Polls queue their reads behind control writes, one request at a time
+            reader = BusScheduler(client, reader, UNIT_ID)
+            serve_control(Controller(reader, register_map))
+        if '--proxy' in sys.argv:
+            # Polls read through the register image, Modbus TCP clients are answered from it
+            reader = RegisterImage(reader, planned_blocks(register_map, masks, profile, max_words), max_words=max_words)
+            start_proxy(reader, PROXY_PORT)
+
+        # Samples go straight to the database; --debug-csv also writes the pivot to /tmp
+        # A slow database only fills the queue, it never delays the next poll
+        sinks = QueuedSink(make_sinks(sys.argv))
+        # --changes stores realtime values only when they move, plus an hourly keyframe
+        deadband = Deadband() if '--changes' in sys.argv else None
+        # Settings are kept as hashed snapshots, only sections that changed reach the sinks
+        snapshots = ConfigSnapshots(register_map)
+
+        schedules = []
+        now = time.monotonic()
+        for group, start, end, interval in SCHEDULES:
+            spans = group_spans(register_map, start, end, masks, profile)
+            schedules.append({'group': group, 'spans': spans, 'interval': interval, 'due': now})
+            logging.info(f"Group {group}: {len(spans)} registers every {interval or 'startup'}")
+
+        while schedules:
+            schedule = min(schedules, key=lambda s: s['due'])
+            delay = schedule['due'] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            if not client.is_socket_open():
+                reconnect(client, reader)
+
+            started = time.monotonic()
+            if metrics.enabled:
+                metrics.observe('sofar_schedule_lag_seconds', max(0.0, started - schedule['due']),
+                                group=schedule['group'])
+            if schedule['group'] == 'config':
+                words = read_group(reader, schedule['spans'], max_words)
+                changed = snapshots.record(words)
+                # Only sections whose raw words changed are stored again
+                words = {address: registers for address, registers in words.items()
+                         if snapshots.section_name(section_start(address)) in changed}
+                register_data = decode_group(register_map, words)
+                if register_data:
+                    logging.info(f"Settings changed in {', '.join(changed)}")
+                    sinks.put(register_data, 'config')
+            elif deadband is not None and schedule['group'] == 'realtime':
+                register_data = poll_group(reader, register_map, schedule['spans'], max_words)
+                for timestamp, samples in changed_samples(deadband, register_data, time.time()):
+                    sinks.put(samples, 'realtime', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)))
+            else:
+                register_data = poll_group(reader, register_map, schedule['spans'], max_words)
+                sinks.put(register_data, 'realtime' if schedule['group'] == 'realtime' else 'config')
+            elapsed = time.monotonic() - started
+            if metrics.enabled:
+                metrics.observe('sofar_cycle_seconds', elapsed, group=schedule['group'])
+            logging.info(f"Polled {schedule['group']}: {len(register_data)} values in {elapsed:.2f}s")
+
+            if schedule['interval'] is None:
+                schedules.remove(schedule)
+            else:
+                # Keep the cadence fixed instead of drifting by the poll duration
+                schedule['due'] += schedule['interval']
+                if schedule['due'] < time.monotonic():
+                    schedule['due'] = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+        if sinks is not None:
+            sinks.close()
+        if snapshots is not None:
+            snapshots.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# sofar_deadband.py
+#
+# Change-only recording: a value is emitted when it leaves its deadband (or,
+# for swinging-door registers, when the line from the last emitted point can
+# no longer describe it), when it has been silent for max_silence seconds,
+# and in a periodic keyframe that repeats every value so state can be rebuilt.
+
+import json
+import math
+import logging
+from fnmatch import fnmatch
+from typing import Any, Dict, List, Tuple
+
+KEYFRAME_INTERVAL = 3600  # Seconds between full keyframes
+STATE_FILE = 'sofar_deadband.json'
+
+DEFAULT_RULE = {
+    'deadband': 0,          # Absolute change that is still "unchanged"
+    'percent': 0,           # Same, relative to the last emitted value
+    'swinging_door': False, # Compress ramps instead of a plain deadband
+    'max_silence': 900,     # Emit at least this often, in seconds
+}
+
+# First matching register name wins, unset keys come from DEFAULT_RULE
+RULES = [
+    ('AddressMask*', {'max_silence': KEYFRAME_INTERVAL}),
+    ('SysTime_*', {'deadband': math.inf, 'max_silence': KEYFRAME_INTERVAL}),  # Ticks every second
+    ('Countdown', {'deadband': math.inf}),
+    ('*Factor*', {'deadband': 0.01}),
+    ('*Power*', {'deadband': 0.02, 'percent': 1, 'swinging_door': True}),
+    ('Voltage_*', {'deadband': 0.5, 'swinging_door': True}),
+    ('Current_*', {'deadband': 0.05, 'swinging_door': True}),
+    ('Frequency_*', {'deadband': 0.02}),
+    ('Temperature_*', {'deadband': 0.5}),
+    ('SOC_*', {'deadband': 1}),
+    ('SOH_*', {'deadband': 1}),
+]
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class Deadband:
+    """Filters {name: value} cycles down to the points worth storing."""
+
+    def __init__(self, rules=RULES, keyframe_interval: float = KEYFRAME_INTERVAL):
+        self.rules = rules
+        self.keyframe_interval = keyframe_interval
+        self.last_keyframe = None
+        # name -> [archived time, archived value, last time, last value, lower slope, upper slope]
+        self.state: Dict[str, list] = {}
+        self.rule_cache: Dict[str, dict] = {}
+
+    def rule(self, name: str) -> dict:
+        rule = self.rule_cache.get(name)
+        if rule is None:
+            rule = dict(DEFAULT_RULE)
+            for pattern, settings in self.rules:
+                if fnmatch(name, pattern):
+                    rule.update(settings)
+                    break
+            self.rule_cache[name] = rule
+        return rule
+
+    def update(self, values: Dict[str, Any], now: float) -> Tuple[List[Tuple[float, str, Any]], bool]:
+        """Returns the (timestamp, name, value) points to store and whether this cycle is a keyframe.
+
+        Swinging-door registers may emit a point from an earlier cycle.
+        """
+        keyframe = self.last_keyframe is None or now - self.last_keyframe >= self.keyframe_interval
+        if keyframe:
+            self.last_keyframe = now
+
+        points = []
+        for name, value in values.items():
+            state = self.state.get(name)
+            if keyframe or state is None:
+                points.append((now, name, value))
+                self.state[name] = [now, value, now, value, -math.inf, math.inf]
+                continue
+
+            archived_time, archived_value, last_time, last_value = state[:4]
+            rule = self.rule(name)
+            if now - archived_time >= rule['max_silence']:
+                emit = True
+            elif not (is_number(value) and is_number(archived_value)):
+                emit = value != archived_value
+            else:
+                deviation = max(rule['deadband'], rule['percent'] / 100 * abs(archived_value))
+                if not rule['swinging_door'] or math.isinf(deviation) or now <= archived_time:
+                    emit = abs(value - archived_value) > deviation
+                else:
+                    emit = False
+                    elapsed = now - archived_time
+                    state[4] = max(state[4], (value - deviation - archived_value) / elapsed)
+                    state[5] = min(state[5], (value + deviation - archived_value) / elapsed)
+                    if state[4] > state[5]:
+                        # The door closed: the previous point ends the segment, restart from it
+                        if last_time > archived_time:
+                            points.append((last_time, name, last_value))
+                            elapsed = now - last_time
+                            deviation = max(rule['deadband'], rule['percent'] / 100 * abs(last_value))
+                            self.state[name] = [last_time, last_value, now, value,
+                                                (value - deviation - last_value) / elapsed,
+                                                (value + deviation - last_value) / elapsed]
+                            continue
+                        emit = True
+
+            if emit:
+                points.append((now, name, value))
+                self.state[name] = [now, value, now, value, -math.inf, math.inf]
+            else:
+                state[2], state[3] = now, value
+        return points, keyframe
+
+    def save(self, path: str = STATE_FILE):
+        with open(path, 'w') as f:
+            json.dump({'last_keyframe': self.last_keyframe, 'state': self.state}, f)
+
+    def load(self, path: str = STATE_FILE):
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.info(f"No deadband state loaded from {path}: {e}")
+            return self
+        self.last_keyframe = saved['last_keyframe']
+        self.state = saved['state']
+        return self
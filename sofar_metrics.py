@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+# sofar_metrics.py
+#
+# Counters and latency histograms for the hot paths (bus requests, decoding,
+# database writes, poll cycles), exported as Prometheus text over HTTP or as a
+# JSON file written periodically. Disabled by default: call sites check
+# metrics.enabled first, so the only cost is one attribute lookup.
+
+import os
+import json
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+METRICS_PORT = 9105
+METRICS_FILE = '/tmp/sofar_metrics.json'
+FILE_INTERVAL = 15  # Seconds between JSON file updates
+
+# Upper bounds in seconds, a 32-word read at 9600 baud takes about 0.1 s
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+HELP = {
+    'sofar_request_seconds': 'Modbus read latency per block',
+    'sofar_request_errors_total': 'Failed Modbus reads per block and kind (timeout, crc, exception, error)',
+    'sofar_request_retries_total': 'Retried Modbus reads per block',
+    'sofar_decode_seconds': 'Time spent decoding a poll',
+    'sofar_db_write_seconds': 'Database write latency per sink (BufferSink is the local SQLite, '
+                              'BufferSink.forward the MySQL write of buffered rows)',
+    'sofar_db_rows_total': 'Rows written per sink',
+    'sofar_db_errors_total': 'Failed sink writes',
+    'sofar_db_dead_letters_total': 'Buffered rows MySQL rejected, moved to the dead_letter table',
+    'sofar_cycle_seconds': 'Poll cycle duration per group',
+    'sofar_schedule_lag_seconds': 'How late a poll started compared to its schedule',
+    'sofar_proxy_requests_total': 'Modbus TCP proxy reads by result (hit, refresh, exception)',
+    'sofar_write_seconds': 'Control write latency from API call to confirmed read-back',
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            names = sorted({name for name, _ in self.counters} | {name for name, _ in self.histograms})
+            for name in names:
+                kind = 'counter' if any(key[0] == name for key in self.counters) else 'histogram'
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+                for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.total:.6f}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {
+                'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                                'sum': round(histogram.total, 6), 'buckets': dict(zip(LATENCY_BUCKETS, histogram.counts))}
+                               for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])],
+            }
+
+    def write_file(self, path: str = METRICS_FILE):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.to_json(), f, indent=1)
+        os.replace(path + '.tmp', path)
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+def block_label(start_address: int, count: int) -> str:
+    return f"0x{start_address:04X}+{count}"
+
+def error_kind(error) -> str:
+    # pymodbus reports timeouts and CRC failures as ModbusIOException text
+    text = str(error).lower()
+    if 'no response' in text or 'timeout' in text or 'timed out' in text:
+        return 'timeout'
+    if 'crc' in text or 'check failed' in text:
+        return 'crc'
+    return 'error'
+
+# The process-wide instance the hot paths report to
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_http(port: int = METRICS_PORT):
+    metrics.enabled = True
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logging.info(f"Prometheus metrics on port {port}")
+    return server
+
+def write_periodically(path: str = METRICS_FILE, interval: float = FILE_INTERVAL):
+    metrics.enabled = True
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                metrics.write_file(path)
+            except OSError as e:
+                logging.error(f"Could not write metrics to {path}: {e}")
+
+    threading.Thread(target=loop, name='metrics-file', daemon=True).start()
+
+def enable_from_argv(argv) -> str:
+    """--metrics-port [PORT] serves Prometheus text, --metrics-file [FILE] writes JSON.
+
+    Returns the JSON path, so one-shot scripts can write a final snapshot.
+    """
+    def value(flag, default):
+        index = argv.index(flag) + 1
+        return argv[index] if index < len(argv) and not argv[index].startswith('--') else default
+
+    path = None
+    if '--metrics-port' in argv:
+        serve_http(int(value('--metrics-port', METRICS_PORT)))
+    if '--metrics-file' in argv:
+        path = value('--metrics-file', METRICS_FILE)
+        write_periodically(path)
+    return path
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# sofar_pipeline.py
+#
+# In-memory hand-off from the poller to the database: decoded samples are
+# pivoted into rows and written by a sink, without the /tmp CSV round trip.
+# The CSV sink is kept for debugging.
+
+import re
+import csv
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, Iterable, List
+from sofar_metrics import metrics
+
+TABLE_NAME = 'inverter_data'
+DEBUG_CSV = '/tmp/pivoted_registers.csv'
+QUEUE_SIZE = 100    # Batches waiting for the writer before data is dropped
+
+# Same cleanup as read.pivot_registers
+SECTION_PREFIX = re.compile(r'^I General\s*[（(].*?[）)]?\s*')
+
+def pivot_samples(samples: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """One row per section with a column per register name, like read.pivot_registers.
+
+    Samples tagged with port and unit_id (sofar_async) get one row per inverter.
+    """
+    rows = {}
+    for sample in samples:
+        section = SECTION_PREFIX.sub('', sample['section'])
+        if 'unit_id' in sample:
+            key = (sample['port'], sample['unit_id'], section)
+            row = rows.setdefault(key, {'section': section, 'port': sample['port'], 'unit_id': sample['unit_id']})
+        else:
+            row = rows.setdefault(section, {'section': section})
+        row[sample['name']] = sample['value']
+    return list(rows.values())
+
+class DbSink:
+    def __init__(self, table_name: str = TABLE_NAME):
+        from db_config import get_db_connection
+        from pivot2db import load_schema_cache
+
+        self.table_name = table_name
+        self.connection = get_db_connection()
+        self.schema_cache = load_schema_cache()
+        self.lock = threading.Lock()  # One connection, shared by several pollers
+
+    def write(self, rows: List[Dict[str, Any]], timestamp: str = None):
+        """Insert rows; rows may carry their own timestamp and sample_key (sofar_buffer)."""
+        from pivot2db import KEY_COLUMN, insert_checked, insert_rows, truncate_column_name
+
+        if not rows:
+            return 0
+        timestamp = timestamp or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # Column names are truncated the same way pivot2db does it for the CSV
+        names = list(dict.fromkeys(name for row in rows for name in row if name != 'timestamp'))
+        columns = {truncate_column_name(name): name for name in names}
+        keyed = KEY_COLUMN in columns
+        with self.lock:
+            self.connection.ping(reconnect=True)
+            try:
+                with self.connection.cursor() as cursor:
+                    count = insert_checked(
+                        cursor, self.table_name, list(columns), self.schema_cache,
+                        lambda: insert_rows(cursor, self.table_name, list(columns) + ['timestamp'],
+                                            ([row.get(name) for name in columns.values()]
+                                             + [row.get('timestamp', timestamp)] for row in rows),
+                                            ignore_duplicates=keyed))
+                self.connection.commit()
+            except Exception:
+                # Batches inserted before the failing one must not ride along with the next commit
+                self.connection.rollback()
+                raise
+        return count
+
+    def close(self):
+        self.connection.close()
+
+class CsvSink:
+    def __init__(self, path: str = DEBUG_CSV):
+        self.path = path
+
+    def write(self, rows: List[Dict[str, Any]], timestamp: str = None):
+        names = list(dict.fromkeys(name for row in rows for name in row))
+        with open(self.path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=names, quoting=csv.QUOTE_NONNUMERIC)
+            writer.writeheader()
+            writer.writerows(rows)
+        return len(rows)
+
+    def close(self):
+        pass
+
+def make_sinks(argv: List[str]) -> list:
+    # Database by default, --no-db to skip it, --debug-csv [FILE] for the old /tmp CSV.
+    # Rows go through the local store-and-forward buffer unless --direct-db is given.
+    # --rollup also keeps the rollup tables (sofar_rollup) current.
+    sinks = []
+    try:
+        if '--direct-db' in argv:
+            sinks.append(DbSink())
+        elif '--no-db' not in argv:
+            from sofar_buffer import BufferSink
+            sinks.append(BufferSink())
+        if '--rollup' in argv:
+            # Minute/hour/day aggregates and energy for the dashboards
+            from sofar_rollup import RollupSink
+            sinks.append(RollupSink())
+        if '--debug-csv' in argv:
+            index = argv.index('--debug-csv') + 1
+            path = argv[index] if index < len(argv) and not argv[index].startswith('--') else DEBUG_CSV
+            sinks.append(CsvSink(path))
+    except Exception:
+        # The sinks opened before the failing one would otherwise keep their connections and threads
+        for sink in sinks:
+            sink.close()
+        raise
+    return sinks
+
+def write_samples(samples: Iterable[Dict[str, Any]], sinks: list, timestamp: str = None):
+    rows = pivot_samples(samples)
+    for sink in sinks:
+        started = time.monotonic()
+        try:
+            count = sink.write(rows, timestamp)
+        except Exception as e:
+            logging.error(f"{type(sink).__name__} failed: {e}")
+            if metrics.enabled:
+                metrics.inc('sofar_db_errors_total', sink=type(sink).__name__)
+            continue
+        if metrics.enabled:
+            metrics.observe('sofar_db_write_seconds', time.monotonic() - started, sink=type(sink).__name__)
+            metrics.inc('sofar_db_rows_total', count or 0, sink=type(sink).__name__)
+
+class QueuedSink:
+    """Bounded queue between the bus reader and the sinks, drained by one writer thread.
+
+    One writer, so batches reach the sinks in poll order and sinks without a
+    lock of their own (CsvSink) are never written twice at once. put() never
+    blocks the poller. When the queue is full the oldest realtime batch is
+    dropped, or the oldest config batch when only config batches are queued.
+    """
+
+    def __init__(self, sinks: list, maxsize: int = QUEUE_SIZE):
+        self.sinks = sinks
+        self.maxsize = maxsize
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._worker, name='sink-writer', daemon=True)
+        self.thread.start()
+
+    def put(self, samples: Iterable[Dict[str, Any]], kind: str = 'realtime', timestamp: str = None):
+        # Timestamp at poll time, the write may happen much later
+        item = (kind, list(samples), timestamp or datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                oldest = next((queued for queued in self.items if queued[0] == 'realtime'), None)
+                if oldest is not None:
+                    self.items.remove(oldest)
+                    self.dropped += 1
+                    logging.warning(f"Sink queue full, dropped realtime batch from {oldest[2]} "
+                                    f"({self.dropped} dropped so far)")
+                elif kind == 'realtime':
+                    self.dropped += 1
+                    return
+                else:
+                    # Settings stay in the snapshot store (sofar_config) even when their rows are lost
+                    oldest = self.items.popleft()
+                    self.dropped += 1
+                    logging.warning(f"Sink queue full of config batches, dropped the one from {oldest[2]} "
+                                    f"({self.dropped} dropped so far)")
+            self.items.append(item)
+            self.condition.notify()
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while not self.items and not self.closed:
+                    self.condition.wait()
+                if not self.items:
+                    return
+                _, samples, timestamp = self.items.popleft()
+            write_samples(samples, self.sinks, timestamp)
+
+    def close(self, timeout: float = 30):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        for sink in self.sinks:
+            sink.close()
@@ -5,6 +5,14 @@ import time
 import pandas as pd
 from pymodbus.client.serial import ModbusSerialClient
 import logging
+from sofar_bus import BlockReader
+from sofar_capture import CaptureWriter, capturing
+from sofar_deadband import Deadband
+from sofar_archive import ArchiveWriter
+from sofar_profile import (apply_profile, load_profile, profile_baudrate, profile_masks, profile_max_register,
+                           profile_max_words)
+from sofar_registers import load_register_map
+from read_planner import apply_address_masks, mapped_spans, mask_addresses, read_address_masks, read_planned
 
 # Set up logging
 logging.basicConfig(filename='sofar_inverter.log', level=logging.ERROR, 
@@ -16,140 +24,109 @@ BAUD_RATE = 9600
 UNIT_ID = 3
 CSV_FILE = 'sofarregister.csv'
 MAX_REGISTER = 0x1324
-BLOCK_SIZE = 32  # Read 32 registers at a time
-OUTPUT_CSV = 'sofar_pivot.csv'  # New output file for pivot CSV
-
-def read_register_info_from_csv(csv_file):
-    register_info = {}
-    current_section = ""
-    with open(csv_file, mode='r', encoding='utf-8') as infile:
-        reader = csv.reader(infile, delimiter=';')
-        next(reader)  # Skip header
-        for row in reader:
-            if row and not row[1] and row[0]:  # New section
-                current_section = row[0].strip()
-            elif len(row) >= 6 and row[1]:  # Register info
-                address_range = row[1].replace(" ", "")
-                if '____' in address_range:
-                    start = address_range.split('____')[0]
-                elif '-' in address_range:
-                    start = address_range.split('-')[0]
-                else:
-                    start = address_range
-
-                try:
-                    address = int(start, 16)
-                except ValueError:
-                    continue
-
-                if address <= MAX_REGISTER:
-                    # Extract numeric part from accuracy
-                    accuracy_str = row[4].replace(',', '.')
-                    try:
-                        accuracy = float(''.join(filter(lambda x: x.isdigit() or x == '.', accuracy_str)))
-                    except ValueError:
-                        accuracy = 1  # Default to 1 if conversion fails
-
-                    register_info[address] = {
-                        'section': current_section,
-                        'name': row[2].strip(),
-                        'type': row[3].strip().upper() if row[3].strip() else 'U16',
-                        'accuracy': accuracy,
-                        'unit': row[5].strip() if len(row) > 5 else ''
-                    }
-    return register_info
-
-def read_register_block(client, start_address, count):
-    try:
-        result = client.read_holding_registers(start_address, count, slave=UNIT_ID)
-        if not result.isError():
-            return result.registers
-        return None
-    except:
-        return None
-
-def decode_value(registers, reg_type, accuracy):
-    if not registers:
-        return None
-    
-    value = None
-    
-    if reg_type == 'U16':
-        value = registers[0]
-    elif reg_type == 'I16':
-        value = registers[0]
-        if value >= 32768:
-            value -= 65536
-    elif reg_type == 'U32':
-        if len(registers) >= 2:
-            value = (registers[0] << 16) | registers[1]
-        else:
-            value = registers[0]
-    elif reg_type == 'I32':
-        if len(registers) >= 2:
-            value = (registers[0] << 16) | registers[1]
-            if value >= 2147483648:
-                value -= 4294967296
-        else:
-            value = registers[0]
-            if value >= 32768:
-                value -= 65536
-    elif reg_type == 'U64':
-        if len(registers) >= 4:
-            value = (registers[0] << 48) | (registers[1] << 32) | (registers[2] << 16) | registers[3]
-        elif len(registers) >= 2:
-            value = (registers[0] << 16) | registers[1]
-        else:
-            value = registers[0]
-    elif reg_type == 'BCD16':
-        value = int(f"{registers[0]:04x}")
-    elif reg_type == 'ASCII':
-        return ''.join(chr(reg >> 8) + chr(reg & 0xFF) for reg in registers).strip('\x00')
-    
-    if value is not None:
-        value *= accuracy
-    
-    return value
+BLOCK_SIZE = 32  # Read 32 registers at a time, unless the device profile allows more
+GAP_TOLERANCE = 8  # Read across up to 8 unmapped registers to merge requests
+OUTPUT_CSV = 'sofar_pivot.csv'  # Old wide CSV, only written with --csv
+CHANGES_CSV = 'sofar_changes.csv'  # Change-only output with --changes, one line per stored value
+
+def read_register_map_from_csv(csv_file):
+    return load_register_map(csv_file, MAX_REGISTER)
+
+def sweep_full(read_block, register_map, failures=None, profile=None):
+    block_size = profile_max_words(profile, BLOCK_SIZE)
+    max_register = profile_max_register(profile, MAX_REGISTER)
+    for start_address in range(0, max_register + 1, block_size):
+        end_address = min(start_address + block_size - 1, max_register)
+        count = end_address - start_address + 1
+        if failures is not None and failures.block_failed(start_address, count):
+            continue
+        registers = read_block(start_address, count)
+
+        if registers:
+            yield from register_map.decode_block(start_address, registers)
+
+def sweep_mapped(read_block, register_map, failures=None, profile=None):
+    # Only request what the CSV maps, minus what the AddressMask registers rule out
+    spans = mapped_spans(register_map, MAX_REGISTER)
+    masks = profile_masks(profile)
+    if masks is None:
+        masks = read_address_masks(read_block, mask_addresses(register_map))
+    spans = apply_profile(apply_address_masks(spans, masks), profile)
+    max_words = profile_max_words(profile, BLOCK_SIZE)
+    for address, registers in read_planned(read_block, spans, GAP_TOLERANCE, max_words, failures).items():
+        register = register_map[address]
+        yield register, register.decode(registers)
+
+def write_changes(values, units):
+    # Deadband state survives between runs, so a value is only written when it moved
+    deadband = Deadband().load()
+    points, keyframe = deadband.update(values, time.time())
+    deadband.save()
+
+    new_file = not pd.io.common.file_exists(CHANGES_CSV)
+    with open(CHANGES_CSV, 'a', newline='') as f:
+        csv_writer = csv.writer(f)
+        if new_file:
+            csv_writer.writerow(['Timestamp', 'Name', 'Value', 'Unit', 'Keyframe'])
+        for timestamp, name, value in sorted(points, key=lambda point: point[0]):
+            formatted_value = f"{value:.4f}" if isinstance(value, (int, float)) else str(value)
+            csv_writer.writerow([time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)), name,
+                                 formatted_value, units[name], int(keyframe)])
+
+    print(f"{len(points)} of {len(values)} values appended to {CHANGES_CSV}" + (" (keyframe)" if keyframe else ""))
 
 def main():
-    client = ModbusSerialClient(method='rtu', port=SERIAL_PORT, baudrate=BAUD_RATE, 
+    profile = load_profile(SERIAL_PORT, UNIT_ID)
+    client = ModbusSerialClient(method='rtu', port=SERIAL_PORT, baudrate=profile_baudrate(profile, BAUD_RATE),
                                 parity='N', stopbits=1, bytesize=8, timeout=1)
     if not client.connect():
         print("Failed to connect to the inverter", file=sys.stderr)
         return
 
-    register_info = read_register_info_from_csv(CSV_FILE)
+    register_map = read_register_map_from_csv(CSV_FILE)
     
     # Dictionary to store the data for pivot
     pivot_data = {}
-
-    for start_address in range(0, MAX_REGISTER + 1, BLOCK_SIZE):
-        end_address = min(start_address + BLOCK_SIZE - 1, MAX_REGISTER)
-        registers = read_register_block(client, start_address, end_address - start_address + 1)
-        
-        if registers:
-            for offset in range(0, len(registers), 2):  # Process two registers at a time
-                address = start_address + offset
-                if address in register_info:
-                    info = register_info[address]
-                    
-                    if info['type'] == 'U32':
-                        value = decode_value(registers[offset:offset+2], info['type'], info['accuracy'])
-                    else:
-                        value = decode_value([registers[offset]], info['type'], info['accuracy'])
-
-                    if value is not None and info['unit'] and value != 0:
-                        # Format the value based on its type
-                        formatted_value = f"{value:.4f}" if isinstance(value, (int, float)) else str(value)
-                        
-                        # Store the value in the pivot_data dictionary with name and unit as key.
-                        pivot_data[f"{info['name']} ({info['unit']})"] = formatted_value
-
-                    # If we processed a U32 value, skip the next register
-                    if info['type'] == 'U32':
-                        offset += 1
+    # Every decoded value, zeros included, for the archive and --changes
+    values = {}
+    units = {}
+
+    sweep = sweep_full if '--full' in sys.argv else sweep_mapped
+    reader = BlockReader(client, UNIT_ID)
+    read_block = reader
+
+    # Keep the raw words as well, so history can be re-decoded after fixing the map
+    capture = None
+    if '--capture' in sys.argv:
+        capture = CaptureWriter(sys.argv[sys.argv.index('--capture') + 1])
+        read_block = capturing(read_block, capture, time.time())
+
+    for info, value in sweep(read_block, register_map, reader.failures, profile):
+        if value is not None:
+            values[info.name] = value
+            units[info.name] = info.unit
+        if value is not None and info.unit and value != 0:
+            # Format the value based on its type
+            formatted_value = f"{value:.4f}" if isinstance(value, (int, float)) else str(value)
+
+            # Store the value in the pivot_data dictionary with name and unit as key.
+            pivot_data[f"{info.name} ({info.unit})"] = formatted_value
 
     client.close()
+    if capture:
+        capture.close()
+
+    if '--changes' in sys.argv:
+        write_changes(values, units)
+        return
+
+    if '--csv' not in sys.argv:
+        # Stable columns from the register map, one file per register and day
+        archive = ArchiveWriter(register_map)
+        archive.append(values)
+        archive.close()
+        print(f"{len(values)} values archived in {archive.archive_dir}")
+        return
 
     # Create DataFrame from pivot_data
     df = pd.DataFrame([pivot_data])
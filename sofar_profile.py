@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# sofar_profile.py
+#
+# Probes an inverter once and stores what its firmware accepts: the largest
+# request size, the AddressMask of every section in sofarregister.csv and the
+# mapped addresses that answer with an illegal-address exception. The pollers
+# load this profile at startup instead of guessing.
+#
+# Usage: sofar_profile.py [--port PORT] [--unit UNIT_ID]
+
+import sys
+import json
+import time
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+PROFILE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sofar_profile.json')
+REQUEST_SIZES = [125, 120, 100, 96, 64, 48, 32, 16, 8]  # Modbus allows at most 125 words
+DEFAULT_MAX_WORDS = 32
+PROBE_ATTEMPTS = 2  # Reads of a register before a silent one is left alone; below sofar_bus.FAIL_LIMIT
+
+def profile_key(port: str, unit_id: int) -> str:
+    return f"{port}:{unit_id}"
+
+def load_profiles(path: str = PROFILE_FILE) -> Dict[str, dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_profile(port: str, unit_id: int, path: str = PROFILE_FILE) -> Optional[dict]:
+    return load_profiles(path).get(profile_key(port, unit_id))
+
+def save_profile(port: str, unit_id: int, profile: dict, path: str = PROFILE_FILE):
+    profiles = load_profiles(path)
+    profiles[profile_key(port, unit_id)] = profile
+    tmp_path = f"{path}.{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def profile_masks(profile: Optional[dict]) -> Optional[Dict[int, int]]:
+    if not profile or 'masks' not in profile:
+        return None
+    return {int(address, 16): mask for address, mask in profile['masks'].items()}
+
+def profile_max_words(profile: Optional[dict], default: int = DEFAULT_MAX_WORDS) -> int:
+    return (profile or {}).get('max_words', default)
+
+def profile_max_register(profile: Optional[dict], default: int) -> int:
+    return (profile or {}).get('max_register', default)
+
+def profile_baudrate(profile: Optional[dict], default: int) -> int:
+    # Set by sofar_baud.py once a faster rate has been verified
+    return (profile or {}).get('baudrate', default)
+
+def apply_profile(spans: List[Tuple[int, int]], profile: Optional[dict]) -> List[Tuple[int, int]]:
+    """Drop spans touching an address range the profile found illegal."""
+    illegal = (profile or {}).get('illegal_ranges')
+    if not illegal:
+        return spans
+    return [(address, width) for address, width in spans
+            if not any(start <= address + width - 1 and address <= end for start, end in illegal)]
+
+def to_ranges(addresses: List[int]) -> List[List[int]]:
+    ranges = []
+    for address in sorted(addresses):
+        if ranges and address == ranges[-1][1] + 1:
+            ranges[-1][1] = address
+        else:
+            ranges.append([address, address])
+    return ranges
+
+def probe_max_words(reader, starts: List[int]) -> int:
+    for count in REQUEST_SIZES:
+        for start in starts:
+            if reader(start, count):
+                return count
+    return min(REQUEST_SIZES)
+
+def probe_register(reader, address: int, width: int) -> str:
+    """'ok', 'illegal' (the device answered exception 2) or 'unanswered' (timeouts only)."""
+    for _ in range(PROBE_ATTEMPTS):
+        if reader(address, width):
+            return 'ok'
+        # block_failed also turns true after repeated timeouts, those leave a timeout count behind
+        if reader.failures.block_failed(address, width) and not reader.timeouts.get((address, width)):
+            return 'illegal'
+    return 'unanswered'
+
+def probe(reader, register_map, max_register: int) -> dict:
+    from read_planner import mapped_spans, mask_addresses, plan_reads, read_address_masks
+
+    # Every mask the CSV knows about, not only the realtime ones
+    masks = read_address_masks(reader, mask_addresses(register_map))
+    print(f"{len(masks)} AddressMask registers answered")
+
+    max_words = probe_max_words(reader, sorted(masks) or [0x0400])
+    print(f"Largest accepted request: {max_words} words")
+
+    spans = mapped_spans(register_map, max_register)
+    illegal = []
+    unanswered = 0
+    for block_start, count in plan_reads(spans, 0, max_words):
+        if reader(block_start, count):
+            continue
+        for address, width in spans:
+            if not block_start <= address < block_start + count:
+                continue
+            state = probe_register(reader, address, width)
+            if state == 'illegal':
+                illegal.extend(range(address, address + width))
+            elif state == 'unanswered':
+                unanswered += 1
+    print(f"{len(illegal)} mapped addresses are not readable")
+    if unanswered:
+        print(f"{unanswered} registers did not answer, they stay in the poll; probe again later")
+    readable = [address + width - 1 for address, width in spans if address not in illegal]
+
+    return {
+        'probed_at': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'max_words': max_words,
+        'max_register': max(readable, default=max_register),
+        'masks': {f"{address:04X}": mask for address, mask in masks.items()},
+        'illegal_ranges': to_ranges(illegal),
+    }
+
+def main():
+    from pymodbus.client.serial import ModbusSerialClient
+    from read import SERIAL_PORT, BAUD_RATE, UNIT_ID, CSV_FILE, MAX_REGISTER, read_register_map_from_csv
+    from sofar_bus import BlockReader
+
+    args = sys.argv[1:]
+    port = args[args.index('--port') + 1] if '--port' in args else SERIAL_PORT
+    unit_id = int(args[args.index('--unit') + 1]) if '--unit' in args else UNIT_ID
+    previous = load_profile(port, unit_id) or {}
+
+    client = ModbusSerialClient(method='rtu', port=port, baudrate=profile_baudrate(previous, BAUD_RATE),
+                                parity='N', stopbits=1, bytesize=8, timeout=1)
+    if not client.connect():
+        print("Failed to connect to the inverter", file=sys.stderr)
+        return
+
+    try:
+        # No retries in the reader: oversized requests fail fast, probe_register retries timeouts itself
+        reader = BlockReader(client, unit_id, retries=0)
+        profile = probe(reader, read_register_map_from_csv(CSV_FILE), MAX_REGISTER)
+    finally:
+        client.close()
+
+    # Keep what other tools stored, e.g. the negotiated baud rate
+    save_profile(port, unit_id, dict(previous, **profile))
+    print(f"Profile for {profile_key(port, unit_id)} saved to {PROFILE_FILE}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+# sofar_proxy.py
+#
+# Modbus TCP proxy: one process owns the RS485 port and keeps an in-memory
+# register image (raw words plus the time each block was read). TCP clients
+# such as Home Assistant or the EMS are answered from the image; a block older
+# than the max-age is read from the bus again first, so any number of clients
+# cost at most one serial read per block per max-age. Blocks clients keep
+# asking for are refreshed in the background just before they expire.
+#
+# Runs on its own, or inside sofar_daemon.py with --proxy so the daemon's own
+# polls keep the image fresh.
+#
+# Usage: sofar_proxy.py [--port 5502] [--max-age 5]
+
+import sys
+import time
+import struct
+import logging
+import threading
+import socketserver
+from typing import Dict, Iterable, List, Optional, Tuple
+from read_planner import GAP_TOLERANCE, apply_address_masks, mapped_spans, plan_reads
+from sofar_metrics import metrics
+
+PROXY_PORT = 5502      # 502 needs root
+MAX_AGE = 5            # Seconds a block is served from the image before it is read again
+REFRESH_AHEAD = 0.8    # Background refresh once a block reaches this fraction of the max-age
+STALE_AFTER = 3        # Multiples of the max-age old words are served while the bus does not answer
+IDLE_AFTER = 60        # Seconds without client reads before a block is no longer refreshed
+REFRESH_POLL = 0.1     # Seconds between checks of the background refresher
+MAX_WORDS = 125        # Largest read a Modbus TCP client may ask for
+
+READ_HOLDING = 3
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+ILLEGAL_VALUE = 3
+GATEWAY_NO_RESPONSE = 0x0B  # Gateway target device failed to respond
+
+MBAP_HEADER = '>HHHB'  # Transaction id, protocol id, length, unit id
+MBAP_SIZE = 7
+
+class RegisterImage:
+    """Raw words of the inverter by address, read through one BlockReader.
+
+    Also a read_block callable, so a poller can read through it and keep the
+    image fresh as a side effect.
+    """
+
+    def __init__(self, reader, blocks: Iterable[Tuple[int, int]] = (), max_age: float = MAX_AGE,
+                 max_words: int = MAX_WORDS):
+        self.reader = reader
+        self.max_age = max_age
+        self.max_words = max_words
+        self.lock = threading.Lock()  # Held for every request on the bus
+        self.words_lock = threading.Lock()  # Held while a block is stored or copied, never during a read
+        self.words: Dict[int, int] = {}
+        self.read_at: Dict[int, float] = {}                 # Address -> when its block was read
+        self.owner: Dict[int, Tuple[int, int]] = {}         # Address -> block it is refreshed with
+        self.requested_at: Dict[Tuple[int, int], float] = {}
+        self.add_blocks(blocks)
+
+    @property
+    def failures(self):
+        return self.reader.failures
+
+    def add_blocks(self, blocks: Iterable[Tuple[int, int]]):
+        for start, count in blocks:
+            for address in range(start, start + count):
+                self.owner.setdefault(address, (start, count))
+
+    def store(self, start_address: int, registers: List[int]):
+        now = time.monotonic()
+        with self.words_lock:
+            for offset, word in enumerate(registers):
+                self.words[start_address + offset] = word
+                self.read_at[start_address + offset] = now
+
+    def __call__(self, start_address: int, count: int) -> Optional[List[int]]:
+        with self.lock:
+            registers = self.reader(start_address, count)
+            if registers is not None:
+                self.store(start_address, registers)
+        return registers
+
+    def age(self, start_address: int, count: int) -> float:
+        now = time.monotonic()
+        return max(now - self.read_at.get(address, float('-inf'))
+                   for address in range(start_address, start_address + count))
+
+    def blocks_for(self, addresses: List[int]) -> List[Tuple[int, int]]:
+        missing = [address for address in addresses if address not in self.owner]
+        if missing:
+            # Addresses outside the planned blocks get blocks of their own
+            self.add_blocks(plan_reads([(address, 1) for address in missing], GAP_TOLERANCE, self.max_words))
+        blocks = []
+        for address in addresses:
+            if self.owner[address] not in blocks:
+                blocks.append(self.owner[address])
+        return blocks
+
+    def refresh(self, block: Tuple[int, int], wanted: Tuple[int, int] = None, max_age: float = None) -> bool:
+        """Read a block unless another thread did while we waited for the bus."""
+        with self.lock:
+            if self.age(*block) <= (self.max_age if max_age is None else max_age):
+                return True
+            registers = None if self.failures.block_failed(*block) else self.reader(*block)
+            if registers is None and wanted is not None and wanted != block \
+                    and not self.failures.block_failed(*wanted):
+                # The whole block was refused, the part the client asked for may still be readable
+                block = wanted
+                registers = self.reader(*block)
+            if registers is not None:
+                self.store(block[0], registers)
+        return registers is not None
+
+    def read(self, start_address: int, count: int) -> Tuple[Optional[List[int]], Optional[int]]:
+        """(words, None) for a client read, or (None, Modbus exception code)."""
+        addresses = list(range(start_address, start_address + count))
+        now = time.monotonic()
+        refreshed = False
+        for block in self.blocks_for(addresses):
+            self.requested_at[block] = now
+            if self.age(*block) <= self.max_age:
+                continue
+            first = max(block[0], start_address)
+            wanted = (first, min(block[0] + block[1], start_address + count) - first)
+            refreshed = True
+            if not self.refresh(block, wanted):
+                if self.failures.block_failed(*wanted):
+                    return self.result(None, ILLEGAL_ADDRESS)
+                if self.age(*wanted) > self.max_age * STALE_AFTER:
+                    # Never read, or the inverter went to sleep: no daytime power reported at night
+                    return self.result(None, GATEWAY_NO_RESPONSE)
+                # The bus did not answer, words read shortly before are better than nothing
+        with self.words_lock:
+            # store() writes a block word by word, a U32 must not be half old, half new
+            words = [self.words[address] for address in addresses]
+        return self.result(words, None, refreshed)
+
+    def result(self, words, exception_code, refreshed=False):
+        if metrics.enabled:
+            outcome = 'exception' if exception_code else 'refresh' if refreshed else 'hit'
+            metrics.inc('sofar_proxy_requests_total', result=outcome)
+        return words, exception_code
+
+    def refresh_loop(self):
+        """Keep the blocks clients read fresh, so their reads never wait for the bus."""
+        while True:
+            now = time.monotonic()
+            due = [(self.age(*block), block) for block, requested in list(self.requested_at.items())
+                   if now - requested < IDLE_AFTER and not self.failures.block_failed(*block)]
+            due = [(age, block) for age, block in due if age >= self.max_age * REFRESH_AHEAD]
+            if not due:
+                time.sleep(REFRESH_POLL)
+                continue
+            _, block = max(due)
+            if not self.refresh(block, max_age=self.max_age * REFRESH_AHEAD):
+                time.sleep(REFRESH_POLL)  # Let the bus recover instead of hammering a failing block
+
+def exception_response(function: int, code: int) -> bytes:
+    return bytes([function | 0x80, code])
+
+def respond(image: RegisterImage, pdu: bytes) -> bytes:
+    function = pdu[0]
+    if function != READ_HOLDING:
+        # Read-only: clients of the proxy never write to the inverter
+        return exception_response(function, ILLEGAL_FUNCTION)
+    if len(pdu) < 5:
+        return exception_response(function, ILLEGAL_VALUE)
+    start_address, count = struct.unpack('>HH', pdu[1:5])
+    if not 1 <= count <= MAX_WORDS or start_address + count > 0x10000:
+        return exception_response(function, ILLEGAL_VALUE)
+    words, exception_code = image.read(start_address, count)
+    if exception_code:
+        return exception_response(function, exception_code)
+    return struct.pack(f'>BB{count}H', function, count * 2, *words)
+
+class ModbusTcpHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        buffer = b''
+        while True:
+            try:
+                data = self.request.recv(1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while len(buffer) >= MBAP_SIZE:
+                transaction, protocol, length, unit_id = struct.unpack(MBAP_HEADER, buffer[:MBAP_SIZE])
+                if len(buffer) < 6 + length:
+                    break
+                pdu, buffer = buffer[MBAP_SIZE:6 + length], buffer[6 + length:]
+                if not pdu:
+                    continue
+                # Any unit id is answered: there is one inverter behind the proxy
+                response = respond(self.server.image, pdu)
+                self.request.sendall(struct.pack(MBAP_HEADER, transaction, protocol, len(response) + 1, unit_id)
+                                     + response)
+
+class ProxyServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, image: RegisterImage, port: int = PROXY_PORT, host: str = ''):
+        super().__init__((host, port), ModbusTcpHandler)
+        self.image = image
+
+def start_proxy(image: RegisterImage, port: int = PROXY_PORT) -> ProxyServer:
+    server = ProxyServer(image, port)
+    threading.Thread(target=server.serve_forever, name='modbus-proxy', daemon=True).start()
+    threading.Thread(target=image.refresh_loop, name='proxy-refresh', daemon=True).start()
+    logging.info(f"Modbus TCP proxy on port {port}, max-age {image.max_age}s")
+    return server
+
+def planned_blocks(register_map, masks: Dict[int, int], profile=None, max_words: int = MAX_WORDS):
+    """The blocks a poll would read, so client reads refresh whole useful blocks."""
+    from read import MAX_REGISTER
+    from sofar_profile import apply_profile
+
+    spans = apply_profile(apply_address_masks(mapped_spans(register_map, MAX_REGISTER), masks), profile)
+    return plan_reads(spans, GAP_TOLERANCE, max_words)
+
+def main():
+    from pymodbus.client.serial import ModbusSerialClient
+    from read import SERIAL_PORT, BAUD_RATE, UNIT_ID, CSV_FILE, TIMEOUT, BLOCK_SIZE, read_register_map_from_csv
+    from read_planner import mask_addresses, read_address_masks
+    from sofar_bus import BlockReader
+    from sofar_daemon import connect
+    from sofar_metrics import enable_from_argv
+    from sofar_profile import load_profile, profile_baudrate, profile_masks, profile_max_words
+
+    args = sys.argv[1:]
+    port = int(args[args.index('--port') + 1]) if '--port' in args else PROXY_PORT
+    max_age = float(args[args.index('--max-age') + 1]) if '--max-age' in args else MAX_AGE
+    enable_from_argv(sys.argv)
+
+    profile = load_profile(SERIAL_PORT, UNIT_ID)
+    client = ModbusSerialClient(method='rtu', port=SERIAL_PORT, baudrate=profile_baudrate(profile, BAUD_RATE),
+                                parity='N', stopbits=1, bytesize=8, timeout=TIMEOUT)
+    connect(client)
+
+    register_map = read_register_map_from_csv(CSV_FILE)
+    reader = BlockReader(client, UNIT_ID, TIMEOUT)
+    masks = profile_masks(profile)
+    if masks is None:
+        masks = read_address_masks(reader, mask_addresses(register_map))
+    max_words = profile_max_words(profile, BLOCK_SIZE)
+    image = RegisterImage(reader, planned_blocks(register_map, masks, profile, max_words), max_age, max_words)
+
+    server = start_proxy(image, port)
+    print(f"Modbus TCP proxy listening on port {port}")
+    try:
+        while True:
+            time.sleep(1)
+            if not client.is_socket_open():
+                with image.lock:
+                    connect(client)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        client.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(filename='sofar_inverter.log', level=logging.ERROR,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+# sofar_registers.py
+#
+# Single parser for sofarregister.csv plus a compiled cache next to the CSV,
+# so the entry points don't re-parse the 45 KB map on every start.
+#
+# The map is a sorted list of Register intervals (start, width, type, scale)
+# with bisect lookups, so multi-word registers are only ever decoded once.
+# Every record carries a decoder precompiled for its type and scale.
+
+import os
+import sys
+import re
+import csv
+import pickle
+import struct
+import hashlib
+import logging
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from read_planner import register_width
+
+CACHE_SUFFIX = '.cache'
+CACHE_VERSION = 2  # Bump whenever the layout of the parsed map changes
+
+ACCURACY_PATTERN = re.compile(r'\d+(?:\.\d+)?')
+
+def parse_accuracy(accuracy_str: str) -> float:
+    match = ACCURACY_PATTERN.search(accuracy_str.replace(',', '.'))
+    return float(match.group()) if match else 1  # Default to 1 if there is no number
+
+STRUCT_FORMATS = {'U16': '>H', 'I16': '>h', 'U32': '>I', 'I32': '>i', 'U64': '>Q'}
+
+# Decimal value of a packed BCD byte, None where a nibble is not a digit
+BCD_BYTES = [(b >> 4) * 10 + (b & 0x0F) if (b >> 4) < 10 and (b & 0x0F) < 10 else None
+             for b in range(256)]
+
+# A decoder takes the big-endian bytes of a block and the byte offset of its register
+Decoder = Callable[[bytes, int], Any]
+
+@lru_cache(maxsize=None)
+def make_decoder(reg_type: str, width: int, scale: float) -> Decoder:
+    if reg_type in STRUCT_FORMATS:
+        unpack_from = struct.Struct(STRUCT_FORMATS[reg_type]).unpack_from
+        if scale == 1:
+            return lambda data, offset: unpack_from(data, offset)[0]
+        return lambda data, offset: unpack_from(data, offset)[0] * scale
+
+    if reg_type == 'BCD16':
+        def decode_bcd(data, offset):
+            high, low = BCD_BYTES[data[offset]], BCD_BYTES[data[offset + 1]]
+            if high is None or low is None:
+                return None
+            return (high * 100 + low) * scale
+        return decode_bcd
+
+    if reg_type == 'ASCII':
+        size = width * 2
+        return lambda data, offset: data[offset:offset + size].decode('latin-1').replace('\x00', '').strip()
+
+    logging.warning(f"Unknown register type: {reg_type}")
+    return lambda data, offset: None
+
+def pack_words(registers: Sequence[int]) -> bytes:
+    return struct.pack(f'>{len(registers)}H', *registers)
+
+def to_bcd(value: int) -> int:
+    return (value // 10) << 4 | value % 10
+
+def encode_value(register, value) -> Optional[List[int]]:
+    """The words a register holds when it decodes to value."""
+    if register.type == 'ASCII':
+        data = str(value).encode('latin-1', 'replace')[:register.width * 2].ljust(register.width * 2, b'\0')
+        return list(struct.unpack(f'>{register.width}H', data))
+    try:
+        raw = round(float(value) / register.scale)
+    except (TypeError, ValueError, OverflowError):  # OverflowError: 'inf'
+        return None
+    if register.type == 'BCD16':
+        raw = max(0, min(raw, 9999))
+        return [to_bcd(raw // 100) << 8 | to_bcd(raw % 100)]
+    raw &= (1 << (16 * register.width)) - 1  # Two's complement for the signed types
+    return [(raw >> (16 * (register.width - 1 - i))) & 0xFFFF for i in range(register.width)]
+
+class Register:
+    FIELDS = ('start', 'width', 'type', 'scale', 'name', 'section', 'unit')
+    __slots__ = FIELDS + ('decoder',)
+
+    def __init__(self, start: int, width: int, type: str, scale: float, name: str, section: str, unit: str):
+        self.start = start
+        self.width = width
+        self.type = type
+        self.scale = scale
+        self.name = name
+        self.section = section
+        self.unit = unit
+        self.decoder = make_decoder(type, width, scale)
+
+    @property
+    def end(self) -> int:
+        return self.start + self.width  # Exclusive
+
+    def decode(self, registers: Sequence[int]) -> Any:
+        if len(registers) < self.width:
+            return None
+        return self.decoder(pack_words(registers), 0)
+
+    # Decoders are closures, so only the fields go into the cache
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.FIELDS, state):
+            setattr(self, field, value)
+        self.decoder = make_decoder(self.type, self.width, self.scale)
+
+    def __repr__(self):
+        return f"Register(0x{self.start:04X}+{self.width}, {self.name!r}, {self.type}, {self.scale})"
+
+class RegisterMap:
+    __slots__ = ('registers', 'starts')
+
+    def __init__(self, registers: List[Register]):
+        self.registers = sorted(registers, key=lambda register: register.start)
+        self.starts = [register.start for register in self.registers]
+
+    def __getstate__(self):
+        return self.registers
+
+    def __setstate__(self, registers):
+        self.registers = registers
+        self.starts = [register.start for register in registers]
+
+    def __len__(self) -> int:
+        return len(self.registers)
+
+    def __iter__(self) -> Iterator[Register]:
+        return iter(self.registers)
+
+    def __contains__(self, address: int) -> bool:
+        return self.get(address) is not None
+
+    def __getitem__(self, address: int) -> Register:
+        register = self.get(address)
+        if register is None:
+            raise KeyError(address)
+        return register
+
+    def get(self, address: int) -> Optional[Register]:
+        """Register starting exactly at address."""
+        index = bisect_left(self.starts, address)
+        if index < len(self.starts) and self.starts[index] == address:
+            return self.registers[index]
+        return None
+
+    def find(self, address: int) -> Optional[Register]:
+        """Register whose interval covers address."""
+        index = bisect_right(self.starts, address) - 1
+        if index >= 0 and address < self.registers[index].end:
+            return self.registers[index]
+        return None
+
+    def between(self, start: int, end: int) -> List[Register]:
+        """Registers starting in start..end (inclusive)."""
+        return self.registers[bisect_left(self.starts, start):bisect_right(self.starts, end)]
+
+    def decode_block(self, block_start: int, registers: Sequence[int]) -> List[Tuple[Register, Any]]:
+        """Decode every register lying completely inside a block in one pass over its bytes."""
+        data = pack_words(registers)
+        block_end = block_start + len(registers)
+        return [(register, register.decoder(data, (register.start - block_start) * 2))
+                for register in self.between(block_start, block_end - 1) if register.end <= block_end]
+
+    def sections(self) -> Dict[str, List[Register]]:
+        sections = {}
+        for register in self.registers:
+            sections.setdefault(register.section, []).append(register)
+        return sections
+
+def parse_address_range(address_range: str):
+    parts = [part for part in re.split(r'-+|_{4}', address_range.replace(" ", "")) if part]
+    start = int(parts[0], 16)
+    end = int(parts[-1], 16) if len(parts) > 1 else start
+    return start, max(end, start)
+
+def parse_register_csv(csv_file: str, max_register: int) -> RegisterMap:
+    registers = []
+    current_section = ""
+
+    with open(csv_file, mode='r', encoding='utf-8') as infile:
+        reader = csv.reader(infile, delimiter=';')
+        next(reader)  # Skip header
+
+        for row in reader:
+            if not row or len(row) < 2:
+                continue
+            if not row[1] and row[0].strip():  # New section
+                current_section = row[0].strip()
+            elif len(row) >= 6 and row[1]:  # Register info
+                try:
+                    start, end = parse_address_range(row[1])
+                except ValueError:
+                    logging.warning(f"Invalid address range '{row[1]}' for '{row[2]}'")
+                    continue
+
+                if registers and start < registers[-1].end and not row[2].strip():
+                    continue  # Continuation word of the previous multi-word register
+
+                if start <= max_register:
+                    reg_type = row[3].strip().upper() if row[3].strip() else 'U16'
+                    # ASCII ranges are one string, numeric ranges are read by their first value
+                    width = end - start + 1 if reg_type == 'ASCII' else register_width(reg_type)
+                    registers.append(Register(start, width, sys.intern(reg_type), parse_accuracy(row[4]),
+                                              row[2].strip(), current_section, row[5].strip()))
+
+    return RegisterMap(registers)
+
+def _file_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def load_register_map(csv_file: str, max_register: int) -> RegisterMap:
+    """Load the register map from the compiled cache, rebuilding it when the CSV changed."""
+    cache_file = csv_file + CACHE_SUFFIX
+    stat = os.stat(csv_file)
+    cached = None
+
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['version'] != CACHE_VERSION or cached['max_register'] != max_register:
+            cached = None
+        elif cached['mtime_ns'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            return cached['register_map']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError, AttributeError):
+        cached = None
+
+    # The mtime moved (e.g. after a copy), only re-parse if the content changed too
+    digest = _file_digest(csv_file)
+    if cached and cached['sha1'] == digest:
+        register_map = cached['register_map']
+    else:
+        register_map = parse_register_csv(csv_file, max_register)
+
+    cached = {
+        'version': CACHE_VERSION,
+        'max_register': max_register,
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha1': digest,
+        'register_map': register_map,
+    }
+    try:
+        tmp_file = f"{cache_file}.{os.getpid()}"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logging.warning(f"Could not write register map cache {cache_file}: {e}")
+
+    return register_map
@@ -0,0 +1,399 @@
+#!/usr/bin/python3
+# sofar_rollup.py
+#
+# Incremental minute/hour/day rollups of the realtime registers: sample count,
+# sum, min, max and mean per register and bucket, plus the energy integrated
+# from Power_PV_Total, Power_Bat_Total and ActivePower_PCC_Total (positive and
+# negative direction separately, in kWh). Dashboards read rollup_minute,
+# rollup_hour and rollup_day instead of aggregating inverter_data.
+#
+# Minutes a power segment crosses without a sample of their own get an
+# energy-only row (samples 0). Each sample updates its minute bucket in O(1). Hour and day rows are derived
+# again from their (at most 60 / 24) child rows whenever a child changes, so
+# every write is an idempotent upsert. Samples are deduplicated by timestamp,
+# section and column set, late samples are merged while their minute is still
+# in memory, and minutes that are gone from memory or started before this
+# process did are rebuilt from inverter_data instead.
+#
+# Runs as a pipeline sink (--rollup on the pollers); --rebuild recomputes a
+# range of days from inverter_data after a backfill or a pivot2db import.
+#
+# Usage: sofar_rollup.py --rebuild YYYY-mm-dd [YYYY-mm-dd]
+
+import sys
+import time
+import logging
+import threading
+from bisect import bisect_left, insort
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Set, Tuple
+from sofar_deadband import DEFAULT_RULE
+
+TABLE_NAME = 'inverter_data'
+ROLLUP_TABLES = {'minute': 'rollup_minute', 'hour': 'rollup_hour', 'day': 'rollup_day'}
+ROLLUP_RANGE = (0x0480, 0x06BF)  # The realtime group of sofar_daemon
+ENERGY_REGISTERS = ('Power_PV_Total', 'Power_Bat_Total', 'ActivePower_PCC_Total')
+# Seconds between power samples beyond which nothing is integrated. With --changes a steady
+# power level is only recorded every max_silence seconds, shorter gaps would integrate it to 0.
+MAX_GAP = DEFAULT_RULE['max_silence']
+LATE_GRACE = MAX_GAP  # Seconds a minute stays in memory after it ends, for late samples and long segments
+FLUSH_INTERVAL = 60   # Seconds between rollup writes
+REBUILD_DELAY = 120   # Seconds before a minute is rebuilt, so buffered rows can reach inverter_data first
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+STAT_COLUMNS = ['samples', 'value_sum', 'value_min', 'value_max', 'value_mean', 'energy_in', 'energy_out']
+KEY_COLUMNS = ['bucket', 'source', 'name']
+META_COLUMNS = {'section', 'port', 'unit_id', 'sample_key', 'timestamp'}
+
+MINUTE = timedelta(minutes=1)
+
+def rollup_names(register_map) -> Set[str]:
+    first, last = ROLLUP_RANGE
+    return {register.name for register in register_map.between(first, last)
+            if register.name and register.type != 'ASCII' and not register.name.lower().startswith('addressmask')}
+
+def minute_of(moment: datetime) -> datetime:
+    return moment.replace(second=0, microsecond=0)
+
+def row_source(row: Dict[str, Any]) -> str:
+    # sofar_async rows carry their inverter, single-inverter pollers leave it empty
+    return f"{row['port']}:{row['unit_id']}" if 'unit_id' in row else ''
+
+def integrate(points: List[Tuple[float, float]], start: float, end: float,
+              max_gap: float = MAX_GAP) -> Tuple[float, float]:
+    """(positive, negative) area of a sampled power curve within start..end, in value-hours.
+
+    Linear between samples, split where the line crosses zero; gaps longer
+    than max_gap (inverter asleep, poller down) count as nothing.
+    """
+    positive = negative = 0.0
+    index = max(0, bisect_left(points, (start,)) - 1)
+    while index + 1 < len(points):
+        (t0, v0), (t1, v1) = points[index], points[index + 1]
+        index += 1
+        if t0 >= end:
+            break
+        if t1 <= start or t1 - t0 > max_gap or t1 == t0:
+            continue
+        a, b = max(t0, start), min(t1, end)
+        va = v0 + (v1 - v0) * (a - t0) / (t1 - t0)
+        vb = v0 + (v1 - v0) * (b - t0) / (t1 - t0)
+        if va >= 0 and vb >= 0:
+            positive += (va + vb) / 2 * (b - a)
+        elif va <= 0 and vb <= 0:
+            negative -= (va + vb) / 2 * (b - a)
+        else:
+            crossing = a + va / (va - vb) * (b - a)
+            for value, width in ((va, crossing - a), (vb, b - crossing)):
+                if value > 0:
+                    positive += value / 2 * width
+                else:
+                    negative -= value / 2 * width
+    return positive / 3600, negative / 3600
+
+def covers(points: List[Tuple[float, float]], start: float, end: float, max_gap: float = MAX_GAP) -> bool:
+    """Whether an integrated segment (see integrate) overlaps start..end."""
+    index = max(0, bisect_left(points, (start,)) - 1)
+    while index + 1 < len(points):
+        (t0, _), (t1, _) = points[index], points[index + 1]
+        index += 1
+        if t0 >= end:
+            break
+        if t1 > start and t0 < t1 <= t0 + max_gap:
+            return True
+    return False
+
+class Rollup:
+    """Open minute buckets and recent power samples, fed one pivoted row at a time."""
+
+    def __init__(self, names: Iterable[str], started: datetime = None, late_grace: float = LATE_GRACE):
+        self.names = set(names)
+        self.started = started or datetime.now()
+        self.late_grace = timedelta(seconds=late_grace)
+        self.newest = datetime.min
+        self.minutes: Dict[Tuple[str, datetime], Dict[str, list]] = {}  # name -> [samples, sum, min, max]
+        self.seen: Dict[Tuple[str, datetime], Set[Tuple[datetime, str, frozenset]]] = {}
+        self.points: Dict[Tuple[str, str], List[Tuple[float, float]]] = {}  # Power samples for integration
+        self.dirty: Set[Tuple[str, datetime]] = set()
+        self.rebuild: Dict[Tuple[str, datetime], float] = {}  # Minute -> when it was found stale
+
+    def open_minute(self, key: Tuple[str, datetime]):
+        """The buckets of a minute, None when it has to be rebuilt from inverter_data instead."""
+        buckets = self.minutes.get(key)
+        if buckets is None:
+            if key[1] < self.started or key[1] + MINUTE + self.late_grace < self.newest:
+                # Part of this minute was counted by an earlier run or already written and dropped
+                self.rebuild.setdefault(key, time.monotonic())
+                return None
+            buckets = self.minutes[key] = {}
+            self.seen[key] = set()
+        return buckets
+
+    def add(self, row: Dict[str, Any], timestamp: datetime):
+        source = row_source(row)
+        key = (source, minute_of(timestamp))
+        self.newest = max(self.newest, timestamp)
+
+        for name in ENERGY_REGISTERS:
+            value = row.get(name)
+            if isinstance(value, (int, float)):
+                self.add_point(source, name, timestamp.timestamp(), float(value))
+
+        buckets = self.open_minute(key)
+        if buckets is None:
+            return
+        # Same key as sofar_buffer.sample_key: a back-dated deadband row for an earlier poll
+        # carries other columns than the row stored for that poll, and is not a replay
+        sample = (timestamp, row.get('section', ''), frozenset(name for name in row if name not in META_COLUMNS))
+        if sample in self.seen[key]:
+            return  # Replayed
+        self.seen[key].add(sample)
+
+        for name, value in row.items():
+            if name in META_COLUMNS or name not in self.names or not isinstance(value, (int, float)):
+                continue
+            stats = buckets.get(name)
+            if stats is None:
+                buckets[name] = [1, value, value, value]
+            else:
+                stats[0] += 1
+                stats[1] += value
+                if value < stats[2]:
+                    stats[2] = value
+                if value > stats[3]:
+                    stats[3] = value
+        self.dirty.add(key)
+
+    def add_point(self, source: str, name: str, moment: float, value: float):
+        points = self.points.setdefault((source, name), [])
+        index = bisect_left(points, (moment,))
+        if index < len(points) and points[index][0] == moment:
+            return
+        insort(points, (moment, value))
+        # Every minute the segments to the neighbouring samples cross gets energy, also minutes
+        # without a sample of their own (a stalled poll, or --changes on a steady level)
+        for neighbour in (index - 1, index + 1):
+            if not 0 <= neighbour < len(points):
+                continue
+            first, last = sorted((moment, points[neighbour][0]))
+            if last - first > MAX_GAP:
+                continue
+            minute = minute_of(datetime.fromtimestamp(first))
+            while minute <= minute_of(datetime.fromtimestamp(last)):
+                key = (source, minute)
+                if self.open_minute(key) is not None:
+                    self.dirty.add(key)
+                minute += MINUTE
+
+    def minute_rows(self, key: Tuple[str, datetime]) -> List[list]:
+        source, minute = key
+        start = minute.timestamp()
+        buckets = self.minutes.get(key, {})
+        rows = []
+        for name in sorted(set(buckets) | set(ENERGY_REGISTERS)):
+            points = self.points.get((source, name))
+            if name not in buckets and not (points and covers(points, start, start + 60)):
+                continue
+            energy_in = energy_out = None
+            if points:
+                energy_in, energy_out = integrate(points, start, start + 60)
+            if name in buckets:
+                samples, total, low, high = buckets[name]
+                rows.append([minute.strftime(TIME_FORMAT), source, name, samples, total, low, high, total / samples,
+                             energy_in, energy_out])
+            else:
+                # Energy only: the minute lies inside a segment between samples of other minutes
+                rows.append([minute.strftime(TIME_FORMAT), source, name, 0, None, None, None, None,
+                             energy_in, energy_out])
+        return rows
+
+    def expire(self) -> List[Tuple[str, datetime]]:
+        """Drop minutes past the late grace that have been written, and old power samples."""
+        if self.newest == datetime.min:
+            return []
+        expired = [key for key in self.minutes
+                   if key[1] + MINUTE + self.late_grace < self.newest and key not in self.dirty]
+        for key in expired:
+            del self.minutes[key]
+            del self.seen[key]
+        oldest = (self.newest - self.late_grace - 2 * MINUTE).timestamp() - MAX_GAP
+        for points in self.points.values():
+            del points[:max(0, bisect_left(points, (oldest,)) - 1)]
+        return expired
+
+def hours_and_days(minutes: Iterable[Tuple[str, datetime]]):
+    hours = {(source, minute.replace(minute=0)) for source, minute in minutes}
+    days = {(source, datetime.combine(hour.date(), datetime.min.time())) for source, hour in hours}
+    return sorted(hours), sorted(days)
+
+def create_rollup_tables(cursor):
+    for table in ROLLUP_TABLES.values():
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS `{table}` (
+                bucket DATETIME NOT NULL,
+                source VARCHAR(32) NOT NULL DEFAULT '',
+                name VARCHAR(64) NOT NULL,
+                samples INT UNSIGNED NOT NULL,
+                value_sum DOUBLE, value_min DOUBLE, value_max DOUBLE, value_mean DOUBLE,
+                energy_in DOUBLE, energy_out DOUBLE,
+                PRIMARY KEY (name, source, bucket),
+                INDEX idx_bucket (bucket)
+            )""")
+
+def upsert_minutes(cursor, rows: List[list]) -> int:
+    from pivot2db import insert_rows
+
+    return insert_rows(cursor, ROLLUP_TABLES['minute'], KEY_COLUMNS + STAT_COLUMNS, rows,
+                       update_columns=STAT_COLUMNS)
+
+def derive(cursor, child: str, parent: str, source: str, bucket: datetime, end: datetime):
+    """Recompute one parent bucket from all of its child rows."""
+    cursor.execute(f"DELETE FROM `{parent}` WHERE source = %s AND bucket = %s", (source, bucket))
+    cursor.execute(f"""
+        INSERT INTO `{parent}` (bucket, source, name, samples, value_sum, value_min, value_max, value_mean,
+                                energy_in, energy_out)
+        SELECT %s, source, name, SUM(samples), SUM(value_sum), MIN(value_min), MAX(value_max),
+               SUM(value_sum) / NULLIF(SUM(samples), 0), SUM(energy_in), SUM(energy_out)
+        FROM `{child}` WHERE source = %s AND bucket >= %s AND bucket < %s
+        GROUP BY source, name""", (bucket, source, bucket, end))
+
+def derive_hours_and_days(cursor, minutes: Iterable[Tuple[str, datetime]]):
+    hours, days = hours_and_days(minutes)
+    for source, hour in hours:
+        derive(cursor, ROLLUP_TABLES['minute'], ROLLUP_TABLES['hour'], source, hour, hour + timedelta(hours=1))
+    for source, day in days:
+        derive(cursor, ROLLUP_TABLES['hour'], ROLLUP_TABLES['day'], source, day, day + timedelta(days=1))
+
+def table_columns(cursor, table_name: str) -> Set[str]:
+    cursor.execute(f"SHOW COLUMNS FROM `{table_name}`")
+    return {row[0] for row in cursor.fetchall()}
+
+def rebuild(cursor, names: Iterable[str], start: datetime, end: datetime, source: str = '',
+            table_name: str = TABLE_NAME):
+    """Recompute the minute rows of start..end for one source from the raw table."""
+    from pivot2db import truncate_column_name
+
+    existing = table_columns(cursor, table_name)
+    columns = {truncate_column_name(name): name for name in names if truncate_column_name(name) in existing}
+    where = "timestamp >= %s AND timestamp < %s"
+    # Samples up to MAX_GAP on either side: the segments into the first and out of the last minute
+    params = [start - timedelta(seconds=MAX_GAP), end + timedelta(seconds=MAX_GAP)]
+    if source:
+        port, _, unit_id = source.rpartition(':')
+        where += " AND port = %s AND unit_id = %s"
+        params += [port, int(unit_id)]
+    elif 'unit_id' in existing:
+        where += " AND unit_id IS NULL"
+    extra = [column for column in ('section', 'port', 'unit_id') if column in existing]
+    cursor.execute(f"SELECT timestamp, {', '.join(f'`{column}`' for column in extra + list(columns))} "
+                   f"FROM `{table_name}` WHERE {where} ORDER BY timestamp", params)
+
+    rollup = Rollup(columns.values(), started=datetime.min, late_grace=(end - start).total_seconds() + 2 * MAX_GAP)
+    for record in cursor.fetchall():
+        row = dict(zip(extra, record[1:1 + len(extra)]))
+        # Only the columns a row holds, so back-dated deadband rows keep their own column set
+        row.update((name, float(value)) for name, value in zip(columns.values(), record[1 + len(extra):])
+                   if value is not None)
+        rollup.add(row, record[0])
+
+    cursor.execute(f"DELETE FROM `{ROLLUP_TABLES['minute']}` WHERE source = %s AND bucket >= %s AND bucket < %s",
+                   (source, start, end))
+    minutes = sorted(key for key in rollup.minutes if start <= key[1] < end)
+    upsert_minutes(cursor, [row for key in minutes for row in rollup.minute_rows(key)])
+
+class RollupSink:
+    """Pipeline sink keeping the rollup tables current; written every FLUSH_INTERVAL."""
+
+    def __init__(self, names: Iterable[str] = None, flush_interval: float = FLUSH_INTERVAL):
+        from db_config import get_db_connection
+
+        if names is None:
+            from read import CSV_FILE, read_register_map_from_csv
+            names = rollup_names(read_register_map_from_csv(CSV_FILE))
+        self.rollup = Rollup(names)
+        self.flush_interval = flush_interval
+        self.flushed_at = time.monotonic()
+        self.connection = get_db_connection()
+        self.lock = threading.Lock()  # QueuedSink's writer thread and close() share the state
+        with self.connection.cursor() as cursor:
+            create_rollup_tables(cursor)
+        self.connection.commit()
+
+    def write(self, rows: List[Dict[str, Any]], timestamp: str = None):
+        default = timestamp or datetime.now().strftime(TIME_FORMAT)
+        with self.lock:
+            for row in rows:
+                moment = row.get('timestamp', default)
+                self.rollup.add(row, datetime.strptime(moment, TIME_FORMAT) if isinstance(moment, str) else moment)
+            if time.monotonic() - self.flushed_at >= self.flush_interval:
+                self.flush()
+        return len(rows)
+
+    def flush(self, force_rebuild: bool = False):
+        rollup = self.rollup
+        now = time.monotonic()
+        self.flushed_at = now
+        dirty = sorted(rollup.dirty)
+        due = [key for key, marked_at in rollup.rebuild.items() if force_rebuild or now - marked_at >= REBUILD_DELAY]
+
+        self.connection.ping(reconnect=True)
+        with self.connection.cursor() as cursor:
+            upsert_minutes(cursor, [row for key in dirty for row in rollup.minute_rows(key)])
+            touched = list(dirty)
+            for source, minute in due:
+                rebuild(cursor, rollup.names, minute, minute + MINUTE, source)
+                touched.append((source, minute))
+            derive_hours_and_days(cursor, touched)
+        self.connection.commit()
+
+        # Only forget what is safely in the database
+        rollup.dirty.difference_update(dirty)
+        for key in due:
+            rollup.rebuild.pop(key, None)
+        rollup.expire()
+
+    def close(self):
+        with self.lock:
+            try:
+                self.flush(force_rebuild=True)
+            finally:
+                self.connection.close()
+
+def main():
+    from db_config import get_db_connection
+    from read import CSV_FILE, read_register_map_from_csv
+
+    args = sys.argv[1:]
+    if '--rebuild' not in args:
+        print("Usage: sofar_rollup.py --rebuild YYYY-mm-dd [YYYY-mm-dd]", file=sys.stderr)
+        sys.exit(2)
+    days = [datetime.strptime(arg, '%Y-%m-%d') for arg in args[args.index('--rebuild') + 1:][:2]]
+    first = days[0] if days else datetime.combine(date.today(), datetime.min.time())
+    last = days[-1] if days else first
+    names = rollup_names(read_register_map_from_csv(CSV_FILE))
+
+    connection = get_db_connection()
+    try:
+        with connection.cursor() as cursor:
+            create_rollup_tables(cursor)
+            sources = ['']
+            if 'unit_id' in table_columns(cursor, TABLE_NAME):
+                cursor.execute(f"SELECT DISTINCT port, unit_id FROM `{TABLE_NAME}` "
+                               f"WHERE unit_id IS NOT NULL AND timestamp >= %s", (first,))
+                sources += [f"{port}:{unit_id}" for port, unit_id in cursor.fetchall()]
+            day = first
+            while day <= last:
+                # One day per transaction, a long range does not hold locks for hours
+                for source in sources:
+                    rebuild(cursor, names, day, day + timedelta(days=1), source)
+                    # Every hour, so hours left without samples lose their old rows too
+                    derive_hours_and_days(cursor, [(source, day + timedelta(hours=hour)) for hour in range(24)])
+                connection.commit()
+                print(f"Rebuilt {day:%Y-%m-%d}")
+                day += timedelta(days=1)
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+# sofar_simulator.py
+#
+# A simulated inverter speaking Modbus RTU frames over TCP. Point a poller at
+# it with SERIAL_PORT = 'socket://127.0.0.1:5020' (pyserial URL). The register
+# image is built from sofarregister.csv and the values captured in
+# result32.txt and sofar_pivot2.csv. Latency, baud rate, illegal address
+# ranges, the largest accepted request and AddressMask contents can be set.
+#
+# The frame handling is done here instead of with a pymodbus server: the
+# server and datastore APIs changed across pymodbus 3.x, and counting bytes and
+# delaying replies needs the raw frames anyway.
+#
+# Usage: sofar_simulator.py [--port 5020] [--unit 3] [--latency 0.02] [--baud 9600]
+#                           [--illegal 0x0600-0x060F] [--mask 0x0480=0xFFFF] [--max-words 125]
+
+import os
+import csv
+import sys
+import time
+import struct
+import logging
+import threading
+import socketserver
+from typing import Dict, Iterable, Optional, Tuple
+from sofar_registers import encode_value
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CSV_FILE = os.path.join(HERE, 'sofarregister.csv')
+CAPTURES = [os.path.join(HERE, 'result32.txt'), os.path.join(HERE, 'sofar_pivot2.csv')]
+MAX_REGISTER = 0x1324  # Same map as the pollers, so they share the parsed-map cache
+PORT = 5020
+UNIT_IDS = [3]
+LATENCY = 0.02        # Seconds the inverter takes to answer, on top of the wire time
+BAUD_RATE = 9600      # 0 disables the wire time emulation
+MAX_WORDS = 125
+BITS_PER_BYTE = 10    # Start bit, 8 data bits, stop bit
+
+READ_HOLDING = 3
+WRITE_SINGLE = 6
+WRITE_MULTIPLE = 16
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+ILLEGAL_VALUE = 3
+
+def crc16(frame: bytes) -> int:
+    crc = 0xFFFF
+    for byte in frame:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+def with_crc(frame: bytes) -> bytes:
+    return frame + struct.pack('<H', crc16(frame))
+
+def load_captured_values(paths: Iterable[str] = CAPTURES) -> Dict[int, str]:
+    """address -> value from read_sofar2 output (result32.txt) and sofar_pivot CSVs."""
+    values = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+        if rows and rows[0][:1] == ['Address']:
+            for row in rows[1:]:
+                if len(row) >= 3 and row[0].startswith('0x') and row[2] != '':
+                    values[int(row[0], 16)] = row[2]
+        elif rows and rows[0][:1] == ['Timestamp']:
+            # Wide pivot: columns are named ADDR_Name, the last row is the newest sample
+            for column, value in zip(rows[0][1:], rows[-1][1:]):
+                prefix = column.strip().split('_', 1)[0]
+                if value != '' and len(prefix) == 4:
+                    try:
+                        values.setdefault(int(prefix, 16), value)
+                    except ValueError:
+                        pass
+    return values
+
+def build_image(register_map, values: Dict[int, str], masks: Dict[int, int] = None) -> Dict[int, int]:
+    image = {}
+    for register in register_map:
+        if register.start in values:
+            words = encode_value(register, values[register.start])
+            if words:
+                for offset, word in enumerate(words):
+                    image[register.start + offset] = word
+
+    # AddressMask registers without a captured value flag every mapped register of their section
+    for register in register_map:
+        if register.name.lower().startswith('addressmask') and not any(
+                image.get(register.start + i) for i in range(register.width)):
+            mask = 0
+            for mapped in register_map.between(register.start, register.start + 63):
+                if mapped.name:
+                    mask |= 1 << (mapped.start - register.start)
+            for offset, word in enumerate(encode_value(register, mask)):
+                image[register.start + offset] = word
+
+    for address, mask in (masks or {}).items():
+        for offset in range(4):
+            image[address + offset] = (mask >> (16 * (3 - offset))) & 0xFFFF
+    return image
+
+class SimulatedInverter:
+    def __init__(self, image: Dict[int, int], unit_ids: Iterable[int] = UNIT_IDS, latency: float = LATENCY,
+                 baudrate: int = BAUD_RATE, illegal_ranges: Iterable[Tuple[int, int]] = (),
+                 max_words: int = MAX_WORDS):
+        self.image = image
+        self.unit_ids = set(unit_ids)
+        self.latency = latency
+        self.baudrate = baudrate
+        self.illegal_ranges = list(illegal_ranges)
+        self.max_words = max_words
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.requests = 0
+        self.exceptions = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def counters(self) -> Dict[str, int]:
+        return {'requests': self.requests, 'exceptions': self.exceptions,
+                'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+    def illegal(self, start: int, count: int) -> bool:
+        return start + count > 0x10000 or any(first <= start + count - 1 and start <= last
+                                              for first, last in self.illegal_ranges)
+
+    def handle(self, frame: bytes) -> Optional[bytes]:
+        """Answer one request frame, None when the inverter would stay silent."""
+        if len(frame) < 4 or crc16(frame[:-2]) != struct.unpack('<H', frame[-2:])[0]:
+            return None
+        unit_id, function = frame[0], frame[1]
+        if unit_id not in self.unit_ids:
+            return None
+
+        with self.lock:
+            self.requests += 1
+            self.bytes_in += len(frame)
+            if function == READ_HOLDING:
+                start, count = struct.unpack('>HH', frame[2:6])
+                if not 1 <= count <= self.max_words:
+                    response = self.exception(unit_id, function, ILLEGAL_VALUE)
+                elif self.illegal(start, count):
+                    response = self.exception(unit_id, function, ILLEGAL_ADDRESS)
+                else:
+                    words = [self.image.get(address, 0) for address in range(start, start + count)]
+                    response = with_crc(struct.pack(f'>BBB{count}H', unit_id, function, count * 2, *words))
+            elif function in (WRITE_SINGLE, WRITE_MULTIPLE):
+                start = struct.unpack('>H', frame[2:4])[0]
+                if function == WRITE_SINGLE:
+                    words = [struct.unpack('>H', frame[4:6])[0]]
+                else:
+                    count = struct.unpack('>H', frame[4:6])[0]
+                    words = list(struct.unpack(f'>{count}H', frame[7:7 + 2 * count]))
+                if self.illegal(start, len(words)):
+                    response = self.exception(unit_id, function, ILLEGAL_ADDRESS)
+                else:
+                    for offset, word in enumerate(words):
+                        self.image[start + offset] = word
+                    response = with_crc(frame[:6])
+            else:
+                response = self.exception(unit_id, function, ILLEGAL_FUNCTION)
+            self.bytes_out += len(response)
+
+        # Wire time of request and reply at the emulated baud rate, plus the inverter's own delay
+        wire_time = (len(frame) + len(response)) * BITS_PER_BYTE / self.baudrate if self.baudrate else 0
+        time.sleep(self.latency + wire_time)
+        return response
+
+    def exception(self, unit_id: int, function: int, code: int) -> bytes:
+        self.exceptions += 1
+        return with_crc(bytes([unit_id, function | 0x80, code]))
+
+def frame_length(buffer: bytes) -> Optional[int]:
+    # Requests have a fixed layout per function, write multiple carries a byte count
+    if len(buffer) < 2:
+        return None
+    if buffer[1] == WRITE_MULTIPLE:
+        return 9 + buffer[6] if len(buffer) >= 7 else None
+    return 8
+
+class RtuOverTcpHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        inverter = self.server.inverter
+        buffer = b''
+        while True:
+            data = self.request.recv(512)
+            if not data:
+                return
+            buffer += data
+            while True:
+                length = frame_length(buffer)
+                if length is None or len(buffer) < length:
+                    break
+                frame, buffer = buffer[:length], buffer[length:]
+                response = inverter.handle(frame)
+                if response is None:
+                    buffer = b''  # A garbled frame, resynchronise on the next request
+                    break
+                self.request.sendall(response)
+
+class SimulatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, inverter: SimulatedInverter, port: int = PORT, host: str = '127.0.0.1'):
+        super().__init__((host, port), RtuOverTcpHandler)
+        self.inverter = inverter
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address
+        return f"socket://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='sofar-simulator', daemon=True).start()
+        return self
+
+def make_simulator(port: int = PORT, masks: Dict[int, int] = None, **options) -> SimulatorServer:
+    from sofar_registers import load_register_map
+
+    register_map = load_register_map(CSV_FILE, MAX_REGISTER)
+    image = build_image(register_map, load_captured_values(), masks)
+    return SimulatorServer(SimulatedInverter(image, **options), port)
+
+def parse_range(text: str) -> Tuple[int, int]:
+    first, _, last = text.partition('-')
+    return int(first, 16), int(last or first, 16)
+
+def main():
+    args = sys.argv[1:]
+
+    def option(name, default, convert):
+        values = [convert(args[i + 1]) for i, arg in enumerate(args) if arg == name]
+        return values if isinstance(default, list) else (values[-1] if values else default)
+
+    masks = dict((int(a, 16), int(m, 16)) for a, m in (text.split('=') for text in option('--mask', [], str)))
+    server = make_simulator(
+        port=option('--port', PORT, int),
+        masks=masks,
+        unit_ids=option('--unit', [], int) or UNIT_IDS,
+        latency=option('--latency', LATENCY, float),
+        baudrate=option('--baud', BAUD_RATE, int),
+        illegal_ranges=option('--illegal', [], parse_range),
+        max_words=option('--max-words', MAX_WORDS, int),
+    )
+    print(f"Simulated inverter listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    main()
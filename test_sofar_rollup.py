@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# test_sofar_rollup.py
+#
+# Energy integration and minute buckets of sofar_rollup, without a database.
+#
+# Usage: python3 -m pytest test_sofar_rollup.py
+
+import unittest
+from datetime import datetime, timedelta
+from sofar_rollup import MAX_GAP, MINUTE, Rollup, integrate, rebuild
+
+PV = 'Power_PV_Total'
+START = datetime(2026, 10, 1, 12, 0, 0)
+
+def energy(rollup, name=PV):
+    """(energy_in, energy_out) summed over every dirty minute."""
+    rows = [row for key in sorted(rollup.dirty) for row in rollup.minute_rows(key) if row[2] == name]
+    return sum(row[8] for row in rows), sum(row[9] for row in rows)
+
+class IntegrateTest(unittest.TestCase):
+    def test_constant_power(self):
+        self.assertAlmostEqual(integrate([(0, 1.0), (60, 1.0)], 0, 60)[0], 1 / 60)
+
+    def test_window_cuts_segment(self):
+        positive, negative = integrate([(0, 0.0), (120, 2.0)], 60, 120)
+        self.assertAlmostEqual(positive, (1.0 + 2.0) / 2 * 60 / 3600)
+        self.assertEqual(negative, 0)
+
+    def test_zero_crossing_is_split(self):
+        positive, negative = integrate([(0, 1.0), (60, -1.0)], 0, 60)
+        self.assertAlmostEqual(positive, 0.5 * 30 / 3600)
+        self.assertAlmostEqual(negative, 0.5 * 30 / 3600)
+
+    def test_long_gap_counts_nothing(self):
+        self.assertEqual(integrate([(0, 1.0), (MAX_GAP + 1, 1.0)], 0, MAX_GAP + 1), (0.0, 0.0))
+
+class RollupTest(unittest.TestCase):
+    def rollup(self):
+        return Rollup([PV, 'Voltage_Phase_R'], started=START - timedelta(hours=1))
+
+    def test_minute_without_samples_gets_energy(self):
+        rollup = self.rollup()
+        rollup.add({'section': 'pv', PV: 1.0}, START)
+        rollup.add({'section': 'pv', PV: 1.0}, START + timedelta(seconds=150))
+        self.assertAlmostEqual(energy(rollup)[0], 150 / 3600)
+        rows = rollup.minute_rows(('', START + MINUTE))
+        self.assertEqual([row[3] for row in rows], [0])  # Energy only, no samples
+
+    def test_steady_level_recorded_by_deadband(self):
+        # --changes emits an unchanged value only every max_silence seconds
+        rollup = self.rollup()
+        rollup.add({'section': 'pv', PV: 2.0}, START)
+        rollup.add({'section': 'pv', PV: 2.0}, START + timedelta(seconds=MAX_GAP))
+        self.assertAlmostEqual(energy(rollup)[0], 2.0 * MAX_GAP / 3600)
+
+    def test_replayed_row_is_ignored(self):
+        rollup = self.rollup()
+        row = {'section': 'grid', 'Voltage_Phase_R': 230.0}
+        rollup.add(row, START)
+        rollup.add(dict(row), START)
+        self.assertEqual(rollup.minutes[('', START)]['Voltage_Phase_R'][0], 1)
+
+    def test_back_dated_row_with_other_columns_counts(self):
+        rollup = self.rollup()
+        rollup.add({'section': 'grid', 'Voltage_Phase_R': 230.0}, START)
+        rollup.add({'section': 'grid', PV: 1.0, 'Voltage_Phase_R': 231.0}, START)
+        self.assertEqual(rollup.minutes[('', START)]['Voltage_Phase_R'][0], 2)
+
+    def test_late_sample_marks_neighbouring_minutes(self):
+        rollup = self.rollup()
+        rollup.add({'section': 'pv', PV: 1.0}, START)
+        rollup.add({'section': 'pv', PV: 1.0}, START + timedelta(seconds=180))
+        rollup.dirty.clear()
+        rollup.add({'section': 'pv', PV: 3.0}, START + timedelta(seconds=90))
+        self.assertEqual(sorted(minute for _, minute in rollup.dirty),
+                         [START + MINUTE * offset for offset in range(4)])
+
+    def test_sources_are_separate(self):
+        rollup = self.rollup()
+        rollup.add({'section': 'pv', 'port': '/dev/ttyUSB0', 'unit_id': 1, PV: 1.0}, START)
+        rollup.add({'section': 'pv', 'port': '/dev/ttyUSB0', 'unit_id': 2, PV: 5.0}, START + timedelta(seconds=60))
+        self.assertEqual(energy(rollup), (0, 0))
+
+class FakeCursor:
+    """Answers rebuild's queries from a list of (timestamp, section, power) rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.result = []
+        self.upserted = []
+
+    def execute(self, sql, params=()):
+        if sql.startswith('SHOW COLUMNS'):
+            self.result = [('id',), ('timestamp',), ('section',), (PV,)]
+        elif sql.startswith('SELECT'):
+            first, last = params
+            self.result = [row for row in self.rows if first <= row[0] < last]
+        else:
+            self.result = []
+
+    def executemany(self, sql, rows):
+        self.upserted.extend(rows)
+
+    def fetchall(self):
+        return self.result
+
+class RebuildTest(unittest.TestCase):
+    def test_segment_after_the_range_is_included(self):
+        samples = [(START, 'pv', 1.0), (START + timedelta(seconds=150), 'pv', 1.0)]
+        cursor = FakeCursor(samples)
+        rebuild(cursor, [PV], START, START + MINUTE)
+        (row,) = cursor.upserted
+        self.assertAlmostEqual(row[8], 60 / 3600)
+
+        rollup = Rollup([PV], started=START - timedelta(hours=1))
+        for moment, section, value in samples:
+            rollup.add({'section': section, PV: value}, moment)
+        self.assertAlmostEqual(row[8], rollup.minute_rows(('', START))[0][8])
+
+if __name__ == '__main__':
+    unittest.main()